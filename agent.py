@@ -1,11 +1,20 @@
-from classes import ChatMessage, ExpenseTrackingOutput
+from classes import ChatMessage, ExpenseTrackingOutput, ExpenseDeltaOutput
+from chunking import chunk_messages, merge_expense_outputs, estimate_tokens, message_tokens
+from config import (OPENAI_MODEL, OPENAI_MAX_CONCURRENCY, EXTRACTION_CHUNK_TOKENS, SETTLEMENT_MINIMIZE_TRANSFERS,
+					EXTRACTION_CACHE_TTL, EXTRACTION_CACHE_MAX_ENTRIES, EXTRACTION_MODE)
+from decimal import Decimal
 from dotenv import load_dotenv
-from openai import OpenAI
-from typing import List
-from utils import calculate_settlement
-from database import (create_group, get_or_create_user, add_user_to_group, 
-					  create_transaction, create_settlement, session_scope, 
-					  update_group, Group, get_user_from_tgId, get_settlements)
+from metrics import stage_timer, LLM_TOKENS, EXTRACTION_CACHE
+from ratelimit import openai_requests_bucket, openai_tokens_bucket
+from summaries import group_summary_cache
+from openai import AsyncOpenAI
+from typing import List, Optional
+from utils import calculate_ledger_settlement, to_cents
+from database import (bulk_save_expense_output, create_settlements, session_scope,
+					  get_group_balance, get_group_paid, get_group_from_tgId, get_users_by_tgIds, get_settlements,
+					  get_cached_extraction, store_cached_extraction, run_db)
+import asyncio
+import hashlib
 import json
 import os
 from sqlalchemy.exc import SQLAlchemyError
@@ -13,88 +22,187 @@ from sqlalchemy.exc import SQLAlchemyError
 load_dotenv()
 
 # Set up your OpenAI API key
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-# Function to call the OpenAI API and get structured output
-def format_chats_to_structured_json(messages: List[ChatMessage], members: List[int], groupId: int):
+# Bounds the number of extraction calls in flight across all chats
+_extraction_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+SYSTEM_PROMPT = "You are an AI assistant that analyzes chat messages and extracts expense information. Format the output as a structured JSON object. Every date should be provided in the following ISO 8601 format: 'YYYY-MM-DD'. For every transaction, set messageId to the message_id of the chat message it was extracted from."
+
+DELTA_SYSTEM_PROMPT = "You are an AI assistant that analyzes chat messages and extracts expense information. Return only the expenses stated in the given messages, as a list of transactions: set tgId to the from_user of the member who paid and messageId to the message_id of the chat message. Do not repeat earlier expenses and do not compute totals. Every date should be provided in the following ISO 8601 format: 'YYYY-MM-DD'."
+
+PROMPTS = {ExpenseTrackingOutput: SYSTEM_PROMPT, ExpenseDeltaOutput: DELTA_SYSTEM_PROMPT}
+
+# Hash everything that determines the model's answer for a window
+def extraction_cache_key(messages: List[ChatMessage], members: List[int], groupId: int, outputModel=ExpenseTrackingOutput) -> str:
+	payload = json.dumps({
+		"model": OPENAI_MODEL,
+		"system": PROMPTS[outputModel],
+		"members": [str(member) for member in members],
+		"groupId": str(groupId),
+		"messages": [msg.content for msg in messages]
+	}, sort_keys=True)
+	return hashlib.sha256(payload.encode()).hexdigest()
+
+# Call the OpenAI API on one message window and get structured output, going through the cache
+async def _extract_window(messages: List[ChatMessage], members: List[int], groupId: int, outputModel=ExpenseTrackingOutput):
+	key = extraction_cache_key(messages, members, groupId, outputModel)
+	cached = await run_db(get_cached_extraction, key, EXTRACTION_CACHE_TTL)
+	if cached is not None:
+		EXTRACTION_CACHE.inc(result="hit")
+		return outputModel.model_validate_json(cached)
+	EXTRACTION_CACHE.inc(result="miss")
+
+	output = await _call_model(messages, members, groupId, outputModel)
+	if output is not None:
+		await run_db(
+			store_cached_extraction, key, OPENAI_MODEL, output.model_dump_json(),
+			EXTRACTION_CACHE_TTL, EXTRACTION_CACHE_MAX_ENTRIES
+		)
+	return output
+
+async def _call_model(messages: List[ChatMessage], members: List[int], groupId: int, outputModel=ExpenseTrackingOutput):
+	prompt = PROMPTS[outputModel]
 	members_str = ", ".join(str(member) for member in members)
-	completion = client.beta.chat.completions.parse(
-		model="gpt-4o-2024-08-06",  # Use the latest model available
-		messages=[
-			{
-				"role": "system",
-				"content": "You are an AI assistant that analyzes chat messages and extracts expense information. Format the output as a structured JSON object. Every date should be provided in the following ISO 8601 format: 'YYYY-MM-DD'."
-			},
-			{"role": "user", "content": f"The list of members is {members_str}. The telegram group id is {groupId}."},
-			*[{"role": "user", "content": json.dumps(msg.content)} for msg in messages]
-		],
-		response_format= ExpenseTrackingOutput,
-	)
-	 
+	header = f"The list of members is {members_str}. The telegram group id is {groupId}."
+
+	# Stay within the account's requests and tokens per minute
+	await openai_requests_bucket.acquire()
+	await openai_tokens_bucket.acquire(estimate_tokens(prompt + header) + sum(message_tokens(msg) for msg in messages))
+
+	async with _extraction_semaphore:
+		with stage_timer("llm_extraction"):
+			completion = await client.beta.chat.completions.parse(
+				model=OPENAI_MODEL,
+				messages=[
+					{"role": "system", "content": prompt},
+					{"role": "user", "content": header},
+					*[{"role": "user", "content": json.dumps(msg.content)} for msg in messages]
+				],
+				response_format=outputModel,
+			)
+
+	if completion.usage:
+		LLM_TOKENS.inc(completion.usage.prompt_tokens, direction="in")
+		LLM_TOKENS.inc(completion.usage.completion_tokens, direction="out")
+
 	message = completion.choices[0].message
 	if message.parsed:
 		result = message.parsed
 	else:
-		print(message.refusal)#
+		print(message.refusal)
+		return None
+	return outputModel(**result.model_dump())
+
+# Extract expenses from token-budgeted windows concurrently and merge the results
+async def extract_expenses(messages: List[ChatMessage], members: List[int], groupId: int) -> Optional[ExpenseTrackingOutput]:
+	chunks = chunk_messages(messages, EXTRACTION_CHUNK_TOKENS)
+	if len(chunks) <= 1:
+		return await _extract_window(messages, members, groupId)
+
+	outputs = await asyncio.gather(*[_extract_window(chunk, members, groupId) for chunk in chunks])
+	# A failed window fails the run so the cursor stays put; successful windows are cached for the retry
+	if any(output is None for output in outputs):
+		print(f"{sum(output is None for output in outputs)} of {len(chunks)} extraction windows failed for chat {groupId}")
+		return None
+	print(f"Merged {len(outputs)} extraction windows for chat {groupId}")
+	return merge_expense_outputs(outputs, len(members))
+
+# Extract only the new transactions, window by window
+async def extract_expense_deltas(messages: List[ChatMessage], members: List[int], groupId: int) -> Optional[ExpenseDeltaOutput]:
+	chunks = chunk_messages(messages, EXTRACTION_CHUNK_TOKENS)
+	outputs = await asyncio.gather(*[_extract_window(chunk, members, groupId, ExpenseDeltaOutput) for chunk in chunks])
+	if any(output is None for output in outputs):
+		print(f"{sum(output is None for output in outputs)} of {len(chunks)} extraction windows failed for chat {groupId}")
 		return None
-	output = ExpenseTrackingOutput(**result.model_dump())
-	
-	# Save to database
+	# Windows do not overlap, so their transactions simply add up
+	return ExpenseDeltaOutput(transactions=[transaction for output in outputs for transaction in output.transactions])
+
+# Persist an extraction result and build the API payload (blocking, run it off the loop)
+def save_expense_output(output: ExpenseTrackingOutput, groupId: int):
 	try:
-		with session_scope() as session:
-			
-			dbGroup = session.query(Group).filter_by(tgId=output.group.tgId).first()
-			if dbGroup:
-				# Update existing group
-				dbGroup = update_group(output.group.tgId, output.group.name, output.group.description, output.group.currency, session=session)
-			else:
-				# Create new group
-				dbGroup = create_group(output.group.name, output.group.description, output.group.currency, output.group.tgId, session=session)
-
-			for member in output.group.members:
-				# Create or get the user
-				dbUser = get_or_create_user(member.tgId, member.username, member.firstName, member.lastName, session=session)
-				
-				# Add user to the group
-				dbGroupMember = add_user_to_group(dbUser.id, dbGroup.id, session=session)
-				
-				# Create transactions for the user
-				for transaction in member.transactions:
-					dbTransaction = create_transaction(
-						dbGroupMember.id,
-						transaction.description,
-						transaction.amount,
-						transaction.date,
-						session=session
-					)
-			
-			# Calculate settlements
-			settlements = calculate_settlement(output.model_dump())
-			
-			# Create settlements
-			for settlement in settlements:
-				payer = settlement['fromUserId']
-				receiver = settlement['toUserId']
-				amount = settlement['amount']
-				create_settlement(payer, receiver, amount, session=session)
-	
-			session.commit()
+		with stage_timer("db_write"), session_scope() as session:
+			dbGroupId = bulk_save_expense_output(output.model_dump(), str(groupId), session=session)
+
+			# Calculate settlements from what the ledger records each member paid
+			settlements = calculate_ledger_settlement(get_group_balance(dbGroupId, session=session), SETTLEMENT_MINIMIZE_TRANSFERS)
+			create_settlements(dbGroupId, settlements, session=session)
 
 	except SQLAlchemyError as e:
 		print(e)
 		raise
 
-	
-	
 	# Create a new dictionary with all the data including settlements
 	finalResult = output.model_dump()
-	finalResult['settlements'] = get_settlements(str(groupId))
+	with session_scope() as session:
+		finalResult['settlements'] = get_settlements(str(groupId), session=session)
+
+		# Fetch every group member's user object in one query
+		finalResult['group']['members'] = get_users_by_tgIds([member['tgId'] for member in finalResult['group']['members']], session=session)
 
-	# for every group member, get the user object
-	formattedMembers = []
-	for member in finalResult['group']['members']:
-		formattedMembers.append(get_user_from_tgId(member['tgId']))
+	return finalResult
 
-	finalResult['group']['members'] = formattedMembers
+# Persist new transactions of a known group and build the API payload from the ledger (blocking)
+def save_expense_delta(delta: ExpenseDeltaOutput, group: dict, members: List[int], groupId: int):
+	transactions = {str(member): [] for member in members}
+	for transaction in delta.transactions:
+		if transaction.tgId not in transactions:
+			print(f"Skipping transaction of non-member {transaction.tgId} in chat {groupId}")
+			continue
+		transactions[transaction.tgId].append(transaction.model_dump(exclude={'tgId'}))
 
-	return finalResult
\ No newline at end of file
+	output = {
+		'group': {
+			'tgId': group['tgId'], 'name': group['name'], 'description': group['description'], 'currency': group['currency'],
+			'members': [
+				{'tgId': tgId, 'username': None, 'firstName': None, 'lastName': None, 'transactions': memberTransactions}
+				for tgId, memberTransactions in transactions.items()
+			]
+		}
+	}
+
+	try:
+		with stage_timer("db_write"), session_scope() as session:
+			dbGroupId = bulk_save_expense_output(output, str(groupId), session=session)
+			settlements = calculate_ledger_settlement(get_group_balance(dbGroupId, session=session), SETTLEMENT_MINIMIZE_TRANSFERS)
+			create_settlements(dbGroupId, settlements, session=session)
+
+	except SQLAlchemyError as e:
+		print(e)
+		raise
+
+	# Totals cover the whole history, as recorded by the ledger
+	with session_scope() as session:
+		paid = get_group_paid(dbGroupId, session=session)
+		users = get_users_by_tgIds(list(paid), session=session)
+		for user in users:
+			user['paid'] = float(to_cents(paid[user['tgId']]))
+		totalExpenses = sum(paid.values(), Decimal('0'))
+
+		output['group']['members'] = users
+		return {
+			**output,
+			'totalExpenses': float(to_cents(totalExpenses)),
+			'averagePerPerson': float(to_cents(totalExpenses / max(len(paid), 1))),
+			'settlements': get_settlements(str(groupId), session=session)
+		}
+
+# Extract expenses from the chat and save them, keeping the event loop free
+async def format_chats_to_structured_json(messages: List[ChatMessage], members: List[int], groupId: int):
+	# A new group needs its name, currency and members from the model, so it gets a full extraction
+	if EXTRACTION_MODE == "delta":
+		group = await run_db(get_group_from_tgId, str(groupId))
+		if group is not None:
+			delta = await extract_expense_deltas(messages, members, groupId)
+			if delta is None:
+				return None
+			result = await asyncio.to_thread(save_expense_delta, delta, group, members, groupId)
+			group_summary_cache.invalidate(str(groupId))
+			return result
+
+	output = await extract_expenses(messages, members, groupId)
+	if output is None:
+		return None
+	result = await asyncio.to_thread(save_expense_output, output, groupId)
+	group_summary_cache.invalidate(str(groupId))
+	return result
@@ -1,18 +1,21 @@
+import asyncio
 import uvicorn
 from dotenv import load_dotenv
 from fastapi import FastAPI
 from telethon import TelegramClient
 
 from routes import create_router
-from bot import setup_bot_handlers
+from bot import setup_bot_handlers, setup_ingestion_handlers
 from database import init_db
-from config import API_ID, API_HASH, BOT_TOKEN, PHONE_NUMBER
+from utils import FastJSONResponse
+from config import API_ID, API_HASH, BOT_TOKEN, PHONE_NUMBER, SCHEDULER_ENABLED
+from scheduler import ChatScheduler
 
 # Load environment variables
 load_dotenv()
 
 # FastAPI app
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 
 # Telethon clients
 client = TelegramClient('user_session', API_ID, API_HASH)
@@ -25,6 +28,9 @@ async def main():
 	await bot_client.start(bot_token=BOT_TOKEN)
 
 	setup_bot_handlers(client)
+	setup_ingestion_handlers(client)
+	if SCHEDULER_ENABLED:
+		asyncio.create_task(ChatScheduler(client).run_forever())
 	api_router = create_router(client)
 	app.include_router(api_router)
 	
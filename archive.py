@@ -0,0 +1,107 @@
+"""
+Append-only, compressed archive of the messages analysed for each chat.
+
+Every append writes one gzip member holding a JSON line per message to the chat's
+current segment file, and records its byte range and message id range in the
+chat's index. Reads use the index to decompress only the blocks they need.
+
+    chat_data/<chat_id>/segment-000001.jsonl.gz
+    chat_data/<chat_id>/index.jsonl
+"""
+from typing import Dict, Iterator, List, Optional
+from config import DATA_DIR, ARCHIVE_SEGMENT_BYTES
+import gzip
+import json
+import os
+
+INDEX_FILE = "index.jsonl"
+
+def _chat_dir(chatId) -> str:
+    return os.path.join(DATA_DIR, str(chatId))
+
+def read_index(chatId) -> List[Dict]:
+    path = os.path.join(_chat_dir(chatId), INDEX_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def _read_last_index_entry(chatId, blockSize: int = 4096) -> Optional[Dict]:
+    """
+    Read the chat's last index entry by scanning backwards from the end of the file.
+    """
+    path = os.path.join(_chat_dir(chatId), INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        tail = b""
+        while position > 0:
+            step = min(blockSize, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+            lines = tail.rstrip().split(b"\n")
+            if len(lines) > 1 or position == 0:
+                line = lines[-1].strip()
+                return json.loads(line) if line else None
+    return None
+
+def append_messages(chatId, messages: List[Dict]) -> int:
+    """
+    Append messages to the chat archive, skipping those already archived.
+
+    :param chatId: Telegram chat id
+    :param messages: Message dictionaries with a message_id key, in id order
+    :return: Number of messages written
+    """
+    last = _read_last_index_entry(chatId)
+    lastMessageId = last["lastMessageId"] if last else 0
+    messages = [message for message in messages if message["message_id"] > lastMessageId]
+    if not messages:
+        return 0
+
+    chatDir = _chat_dir(chatId)
+    os.makedirs(chatDir, exist_ok=True)
+    segment = last["segment"] if last else "segment-000001.jsonl.gz"
+    segmentPath = os.path.join(chatDir, segment)
+    if os.path.exists(segmentPath) and os.path.getsize(segmentPath) >= ARCHIVE_SEGMENT_BYTES:
+        segment = f"segment-{int(segment[8:14]) + 1:06d}.jsonl.gz"
+        segmentPath = os.path.join(chatDir, segment)
+
+    block = gzip.compress("".join(json.dumps(message) + "\n" for message in messages).encode())
+    with open(segmentPath, "ab") as f:
+        offset = f.tell()
+        f.write(block)
+
+    entry = {
+        "segment": segment,
+        "offset": offset,
+        "length": len(block),
+        "firstMessageId": messages[0]["message_id"],
+        "lastMessageId": messages[-1]["message_id"],
+        "count": len(messages)
+    }
+    with open(os.path.join(chatDir, INDEX_FILE), "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    return len(messages)
+
+def iter_messages(chatId, minId: int = 0, maxId: Optional[int] = None) -> Iterator[Dict]:
+    """
+    Stream archived messages with minId < message_id <= maxId, in id order.
+
+    :param chatId: Telegram chat id
+    :param minId: Exclusive lower bound on the message id
+    :param maxId: Inclusive upper bound on the message id, or None for no bound
+    """
+    chatDir = _chat_dir(chatId)
+    for entry in read_index(chatId):
+        if entry["lastMessageId"] <= minId or (maxId is not None and entry["firstMessageId"] > maxId):
+            continue
+        with open(os.path.join(chatDir, entry["segment"]), "rb") as f:
+            f.seek(entry["offset"])
+            block = gzip.decompress(f.read(entry["length"]))
+        for line in block.decode().splitlines():
+            message = json.loads(line)
+            if message["message_id"] > minId and (maxId is None or message["message_id"] <= maxId):
+                yield message
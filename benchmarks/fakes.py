@@ -0,0 +1,159 @@
+"""
+Local stand-ins for the Telegram and OpenAI clients, generating synthetic groups,
+members and expense messages with configurable scale and latency.
+"""
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import asyncio
+import json
+import random
+import re
+
+from telethon.tl.functions.messages import GetCommonChatsRequest
+from telethon.tl.types import Chat, ChatPhotoEmpty, Message, PeerChat, PeerUser
+
+from classes import ExpenseDeltaOutput
+
+CHATTER = ["hi all", "see you later", "ok", "lol", "who's coming tonight?", "great idea", "thanks!", "on my way"]
+EXPENSES = ["dinner", "groceries", "taxi", "tickets", "hotel", "fuel", "drinks", "rent"]
+AMOUNT = re.compile(r"(\d+(?:\.\d{1,2})?) EUR")
+
+
+class FakeMessage(Message):
+    # Real Telethon messages only expose .text once bound to a client
+    @property
+    def text(self):
+        return self.message
+
+
+class FakeTelegramClient:
+    """
+    Serves synthetic groups through the subset of TelegramClient used by the app.
+
+    Each group has `members` users and `messages` messages, about `expenseRatio` of
+    which state an expense. Every call waits `latency` seconds.
+    """
+
+    def __init__(self, groups: int = 10, members: int = 5, messages: int = 200,
+                 expenseRatio: float = 0.3, latency: float = 0.05, seed: int = 0):
+        self.latency = latency
+        rng = random.Random(seed)
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.chats = {}
+        self.members = {}
+        self.messages = {}
+        for groupIndex in range(1, groups + 1):
+            chat = Chat(id=groupIndex, title=f"Group {groupIndex}", photo=ChatPhotoEmpty(),
+                        participants_count=members, date=start, version=1)
+            userIds = [groupIndex * 1000 + memberIndex for memberIndex in range(members)]
+            history = []
+            for messageId in range(1, messages + 1):
+                if rng.random() < expenseRatio:
+                    text = f"I paid {rng.randint(100, 20000) / 100:.2f} EUR for {rng.choice(EXPENSES)}"
+                else:
+                    text = rng.choice(CHATTER)
+                history.append(FakeMessage(
+                    id=messageId, peer_id=PeerChat(groupIndex), date=start + timedelta(minutes=messageId),
+                    message=text, from_id=PeerUser(rng.choice(userIds))
+                ))
+            self.chats[-groupIndex] = chat
+            self.members[-groupIndex] = userIds
+            self.messages[-groupIndex] = history
+
+    @property
+    def chat_ids(self):
+        return list(self.chats)
+
+    def on(self, *args, **kwargs):
+        return lambda handler: handler
+
+    async def get_entity(self, chatId):
+        await asyncio.sleep(self.latency)
+        return self.chats[int(chatId)]
+
+    async def iter_participants(self, chat):
+        await asyncio.sleep(self.latency)
+        for userId in self.members[-chat.id]:
+            yield SimpleNamespace(id=userId, bot=False)
+
+    async def iter_messages(self, chat, limit: int = None, min_id: int = 0, reverse: bool = False, **kwargs):
+        await asyncio.sleep(self.latency)
+        history = [message for message in self.messages[-chat.id] if message.id > min_id]
+        for message in (history if reverse else reversed(history))[:limit]:
+            yield message
+
+    async def __call__(self, request):
+        await asyncio.sleep(self.latency)
+        if isinstance(request, GetCommonChatsRequest):
+            return SimpleNamespace(chats=list(self.chats.values())[:request.limit])
+        raise NotImplementedError(type(request).__name__)
+
+
+class _FakeCompletions:
+    def __init__(self, latency: float, tokenLatency: float):
+        self.latency = latency
+        self.tokenLatency = tokenLatency
+
+    async def parse(self, model, messages, response_format, **kwargs):
+        # The second message names the members and the group, the rest are chat messages
+        header = messages[1]["content"]
+        members = re.search(r"members is (.*)\. The telegram group id is (.*)\.", header)
+        memberIds, groupId = members.group(1).split(", "), members.group(2)
+        chatMessages = [json.loads(message["content"]) for message in messages[2:]]
+
+        transactions = {memberId: [] for memberId in memberIds}
+        for message in chatMessages:
+            match = AMOUNT.search(message["text"])
+            if match and message["from_user"] in transactions:
+                transactions[message["from_user"]].append({
+                    "messageId": message["message_id"],
+                    "description": message["text"].rsplit(" for ", 1)[-1],
+                    "amount": float(match.group(1)),
+                    "date": message["date"][:10]
+                })
+
+        promptTokens = sum(len(message["content"]) // 4 for message in messages)
+        if response_format is ExpenseDeltaOutput:
+            output = response_format(transactions=[
+                {"tgId": memberId, **transaction}
+                for memberId, items in transactions.items()
+                for transaction in items
+            ])
+        else:
+            output = self._full_output(response_format, memberIds, groupId, transactions)
+
+        completionTokens = len(output.model_dump_json()) // 4
+        await asyncio.sleep(self.latency + completionTokens * self.tokenLatency)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(parsed=output, refusal=None))],
+            usage=SimpleNamespace(prompt_tokens=promptTokens, completion_tokens=completionTokens)
+        )
+
+    @staticmethod
+    def _full_output(response_format, memberIds, groupId, transactions):
+        paid = {memberId: round(sum(t["amount"] for t in items), 2) for memberId, items in transactions.items()}
+        total = round(sum(paid.values()), 2)
+        return response_format(
+            group={
+                "id": abs(int(groupId)), "tgId": groupId, "name": f"Group {abs(int(groupId))}",
+                "description": None, "currency": "EUR",
+                "members": [
+                    {"userId": int(memberId), "tgId": memberId, "username": f"user{memberId}", "firstName": None,
+                     "lastName": None, "paid": paid[memberId], "transactions": transactions[memberId]}
+                    for memberId in memberIds
+                ]
+            },
+            totalExpenses=total,
+            averagePerPerson=round(total / max(len(memberIds), 1), 2)
+        )
+
+
+class FakeAsyncOpenAI:
+    """
+    Answers structured extraction calls by reading the amounts out of the messages.
+
+    Each call waits `latency` seconds plus `tokenLatency` per output token.
+    """
+
+    def __init__(self, latency: float = 0.5, tokenLatency: float = 0.002):
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=_FakeCompletions(latency, tokenLatency)))
@@ -0,0 +1,44 @@
+"""
+Benchmark the settlement engine on large synthetic groups.
+
+Run from the repository root:
+    python benchmarks/settlement_benchmark.py
+"""
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import calculate_ledger_settlement
+
+SCENARIOS = [
+    (100, 1_000),
+    (1_000, 10_000),
+    (5_000, 50_000),
+    (10_000, 100_000),
+]
+
+def build_ledger(memberCount: int, transactionCount: int, rng: random.Random):
+    paid = {str(1_000_000 + index): Decimal('0') for index in range(memberCount)}
+    members = list(paid)
+    for _ in range(transactionCount):
+        paid[rng.choice(members)] += Decimal(rng.randint(100, 50_000)) / 100
+    return paid
+
+def run(memberCount: int, transactionCount: int, minimizeTransfers: bool):
+    ledger = build_ledger(memberCount, transactionCount, random.Random(memberCount))
+    start = time.perf_counter()
+    settlements = calculate_ledger_settlement(ledger, minimizeTransfers)
+    elapsed = time.perf_counter() - start
+    return elapsed, len(settlements)
+
+if __name__ == "__main__":
+    print(f"{'members':>8} {'transactions':>13} {'mode':>8} {'transfers':>10} {'ms':>10}")
+    for memberCount, transactionCount in SCENARIOS:
+        for minimizeTransfers in (False, True):
+            elapsed, transfers = run(memberCount, transactionCount, minimizeTransfers)
+            mode = "minimal" if minimizeTransfers else "greedy"
+            print(f"{memberCount:>8} {transactionCount:>13} {mode:>8} {transfers:>10} {elapsed * 1000:>10.1f}")
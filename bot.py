@@ -1,6 +1,7 @@
 from telethon import events
 from config import ALLOWED_CHATS
-from message_processing import process_messages
+from database import store_chat_messages, store_chat_participants, run_db
+from message_processing import process_messages, message_to_row
 
 def setup_bot_handlers(client):
     @client.on(events.NewMessage(pattern='/start'))
@@ -11,12 +12,26 @@ def setup_bot_handlers(client):
     @client.on(events.NewMessage(pattern='/analyze'))
     async def analyze_now(event):
         await event.reply("Starting analysis...")
-        await process_messages(event.chat_id)
+        await process_messages(event.client, event.chat_id)
         await event.reply("Analysis complete.")
 
-# Scheduled task for message processing (commented out for now)
-# async def schedule_message_processing(client):
-#     while True:
-#         for chat_id in ALLOWED_CHATS:
-#             await process_messages(chat_id)
-#         await asyncio.sleep(3600)  # Process every hour
\ No newline at end of file
+def setup_ingestion_handlers(client):
+    # Keep the local message store current so analyses never wait on Telegram. Only
+    # allowed chats are stored, the account's other groups never reach the database
+    @client.on(events.NewMessage(chats=ALLOWED_CHATS, func=lambda e: e.is_group))
+    @client.on(events.MessageEdited(chats=ALLOWED_CHATS, func=lambda e: e.is_group))
+    async def ingest_message(event):
+        if not event.message.text:
+            return
+        sender = await event.get_sender()
+        row = message_to_row(event.chat_id, event.message, bool(getattr(sender, 'bot', False)))
+        await run_db(store_chat_messages, [row])
+
+    @client.on(events.ChatAction(chats=ALLOWED_CHATS))
+    async def ingest_membership(event):
+        if not (event.user_joined or event.user_added or event.user_left or event.user_kicked):
+            return
+        active = event.user_joined or event.user_added
+        users = await event.get_users()
+        participants = [(user.id, bool(getattr(user, 'bot', False))) for user in users]
+        await run_db(store_chat_participants, event.chat_id, participants, active)
\ No newline at end of file
@@ -0,0 +1,101 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Tuple, Type
+
+
+class RateLimited(Exception):
+    def __init__(self, retryAfter: float):
+        super().__init__(f"Rate limited, retry in {retryAfter:.0f} seconds")
+        self.retryAfter = retryAfter
+
+
+class AsyncTTLCache:
+    """
+    Cache the results of an async loader per key.
+
+    Fresh entries are served for ttl seconds. For staleTtl seconds after that the
+    stale value is still served while a single background refresh runs; a failed
+    refresh keeps the stale value and is retried after negativeTtl seconds. Loader
+    errors without a value to fall back on are cached for negativeTtl seconds. When
+    the loader is rate limited (one of rateLimitErrors, with a `seconds` attribute)
+    the stale value keeps being served until the limit expires; without one,
+    RateLimited is raised until then without calling the loader again.
+    """
+
+    def __init__(self, loader: Callable[[Any], Awaitable], ttl: float, staleTtl: float, negativeTtl: float,
+                 rateLimitErrors: Tuple[Type[Exception], ...] = ()):
+        self.loader = loader
+        self.ttl = ttl
+        self.staleTtl = staleTtl
+        self.negativeTtl = negativeTtl
+        self.rateLimitErrors = rateLimitErrors
+        self._entries: Dict[Any, dict] = {}
+        self._refreshing: Dict[Any, asyncio.Task] = {}
+        self._generation = 0
+
+    async def get(self, key):
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry:
+            age = now - entry["fetchedAt"]
+            if "value" not in entry:
+                if now < entry.get("retryAt", 0):
+                    raise RateLimited(entry["retryAt"] - now)
+                if "error" in entry and age < self.negativeTtl:
+                    raise entry["error"]
+            elif age < self.ttl:
+                return entry["value"]
+            elif age < self.ttl + self.staleTtl:
+                if now >= entry.get("retryAt", 0):
+                    self._refresh(key)
+                return entry["value"]
+            elif now < entry.get("retryAt", 0):
+                return entry["value"]
+        return await asyncio.shield(self._refresh(key))
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+        self._refreshing.pop(key, None)
+        # A load already in flight may have read the old state, its result is dropped
+        self._generation += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._refreshing.clear()
+        self._generation += 1
+
+    def _refresh(self, key) -> asyncio.Task:
+        # At most one load per key is in flight
+        task = self._refreshing.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key))
+            self._refreshing[key] = task
+            task.add_done_callback(lambda done: self._refreshing.get(key) is done and self._refreshing.pop(key))
+            # Background refreshes nobody awaits must not log unretrieved exceptions
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return task
+
+    async def _load(self, key):
+        generation = self._generation
+        try:
+            value = await self.loader(key)
+        except self.rateLimitErrors as e:
+            retryAfter = getattr(e, "seconds", 0)
+            entry = self._entries.get(key)
+            if entry and "value" in entry:
+                entry["retryAt"] = time.monotonic() + retryAfter
+                return entry["value"]
+            if generation == self._generation:
+                self._entries[key] = {"retryAt": time.monotonic() + retryAfter, "fetchedAt": time.monotonic()}
+            raise RateLimited(retryAfter) from e
+        except Exception as e:
+            entry = self._entries.get(key)
+            if entry and "value" in entry and time.monotonic() - entry["fetchedAt"] < self.ttl + self.staleTtl:
+                entry["retryAt"] = time.monotonic() + self.negativeTtl
+                return entry["value"]
+            if generation == self._generation:
+                self._entries[key] = {"error": e, "fetchedAt": time.monotonic()}
+            raise
+        if generation == self._generation:
+            self._entries[key] = {"value": value, "fetchedAt": time.monotonic()}
+        return value
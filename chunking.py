@@ -0,0 +1,97 @@
+from decimal import Decimal, ROUND_HALF_UP
+from typing import List
+from classes import ChatMessage, ExpenseTrackingOutput
+import json
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except ImportError:
+    _encoding = None
+
+# Per-message overhead of the chat format (role, separators)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a text, using tiktoken when it is installed.
+
+    :param text: Text to measure
+    :return: Token count (approximate without tiktoken)
+    """
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # Roughly four characters per token for mixed chat text
+    return len(text) // 4 + 1
+
+def message_tokens(message: ChatMessage) -> int:
+    return estimate_tokens(json.dumps(message.content)) + MESSAGE_TOKEN_OVERHEAD
+
+def chunk_messages(messages: List[ChatMessage], maxTokens: int) -> List[List[ChatMessage]]:
+    """
+    Split messages into consecutive windows that each fit in the token budget.
+
+    A single message larger than the budget gets a window of its own.
+
+    :param messages: Messages in chronological order
+    :param maxTokens: Token budget for the messages of one window
+    :return: List of message windows, in order
+    """
+    chunks = []
+    current = []
+    currentTokens = 0
+    for message in messages:
+        tokens = message_tokens(message)
+        if current and currentTokens + tokens > maxTokens:
+            chunks.append(current)
+            current = []
+            currentTokens = 0
+        current.append(message)
+        currentTokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+def merge_expense_outputs(outputs: List[ExpenseTrackingOutput], memberCount: int) -> ExpenseTrackingOutput:
+    """
+    Merge the per-window extraction results into a single group result.
+
+    Windows do not overlap, so transactions are concatenated in window order and
+    each member's paid amount is the sum over windows. Totals are recomputed.
+
+    :param outputs: Extraction results, in window order
+    :param memberCount: Number of group members sharing the expenses
+    :return: Combined extraction result
+    """
+    base = outputs[0].model_dump()
+    group = base['group']
+    members = {}
+    paid = {}
+    for output in outputs:
+        data = output.model_dump()
+        for field in ('name', 'description', 'currency'):
+            if not group.get(field) and data['group'].get(field):
+                group[field] = data['group'][field]
+        for member in data['group']['members']:
+            tgId = member['tgId']
+            if tgId not in members:
+                members[tgId] = {**member, 'transactions': []}
+                paid[tgId] = Decimal('0')
+            else:
+                for field in ('username', 'firstName', 'lastName'):
+                    if not members[tgId].get(field) and member.get(field):
+                        members[tgId][field] = member[field]
+            members[tgId]['transactions'].extend(member['transactions'])
+            paid[tgId] += Decimal(str(member['paid']))
+
+    for tgId, member in members.items():
+        member['paid'] = float(paid[tgId].quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+    group['members'] = list(members.values())
+
+    totalExpenses = sum(paid.values(), Decimal('0'))
+    averagePerPerson = totalExpenses / max(memberCount, len(members), 1)
+    return ExpenseTrackingOutput(
+        group=group,
+        totalExpenses=float(totalExpenses.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)),
+        averagePerPerson=float(averagePerPerson.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)),
+    )
@@ -6,6 +6,7 @@ class ChatMessage(BaseModel):
     content: dict
 
 class Transaction(BaseModel):
+    messageId: int
     description: str
     amount: float
     date: str
@@ -40,4 +41,14 @@ class User(BaseModel):
 class ExpenseTrackingOutput(BaseModel):
     group: Group
     totalExpenses: float
-    averagePerPerson: float
\ No newline at end of file
+    averagePerPerson: float
+
+class DeltaTransaction(BaseModel):
+    tgId: str
+    messageId: int
+    description: str
+    amount: float
+    date: str
+
+class ExpenseDeltaOutput(BaseModel):
+    transactions: List[DeltaTransaction]
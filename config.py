@@ -13,4 +13,55 @@ TEST_USER_ID = int(os.getenv("TEST_USER_ID"))
 PHONE_NUMBER = os.getenv("PHONE_NUMBER")
 
 # Ensure data directory exists
-os.makedirs(DATA_DIR, exist_ok=True)
\ No newline at end of file
+os.makedirs(DATA_DIR, exist_ok=True)
+
+# OpenAI extraction settings
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-2024-08-06")
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "4"))
+
+# Token budget for the messages sent in one extraction call
+EXTRACTION_CHUNK_TOKENS = int(os.getenv("EXTRACTION_CHUNK_TOKENS", "6000"))
+
+# "delta" asks the model only for the new transactions of groups already in the database
+# and derives totals from the ledger, "full" asks for the whole group state every time
+EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "delta").lower()
+
+# Pair exactly matching debts and credits before the greedy settlement pass
+SETTLEMENT_MINIMIZE_TRANSFERS = os.getenv("SETTLEMENT_MINIMIZE_TRANSFERS", "false").lower() == "true"
+
+# Background analysis jobs
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))  # Seconds a finished job stays queryable
+
+# Seconds a finished analysis is reused by callers asking for the same chat
+SINGLE_FLIGHT_TTL = float(os.getenv("SINGLE_FLIGHT_TTL", "5"))
+
+# Persistent cache of extraction results
+EXTRACTION_CACHE_TTL = int(os.getenv("EXTRACTION_CACHE_TTL", str(7 * 24 * 3600)))  # Seconds
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", "10000"))
+
+# Local pre-filter dropping messages unlikely to describe an expense
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "true").lower() == "true"
+PREFILTER_CONTEXT = int(os.getenv("PREFILTER_CONTEXT", "1"))  # Neighbouring messages kept around a match
+
+# Size after which the message archive of a chat starts a new segment file
+ARCHIVE_SEGMENT_BYTES = int(os.getenv("ARCHIVE_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+
+# Cache of the /groups lookup, in seconds
+GROUPS_CACHE_TTL = int(os.getenv("GROUPS_CACHE_TTL", "60"))
+GROUPS_CACHE_STALE_TTL = int(os.getenv("GROUPS_CACHE_STALE_TTL", "600"))  # Extra time a stale entry is served while refreshing
+GROUPS_CACHE_NEGATIVE_TTL = int(os.getenv("GROUPS_CACHE_NEGATIVE_TTL", "30"))
+
+# Seconds a group summary is cached; ledger writes in this process invalidate it earlier
+GROUP_SUMMARY_CACHE_TTL = int(os.getenv("GROUP_SUMMARY_CACHE_TTL", "300"))
+
+# Scheduled processing of many chats
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "false").lower() == "true"
+SCHEDULER_INTERVAL = int(os.getenv("SCHEDULER_INTERVAL", "3600"))  # Seconds between passes
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "8"))
+
+# Rate limits shared by every caller in the process
+TELEGRAM_REQUESTS_PER_SECOND = float(os.getenv("TELEGRAM_REQUESTS_PER_SECOND", "1"))
+TELEGRAM_BURST = int(os.getenv("TELEGRAM_BURST", "5"))
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "30000"))
@@ -1,25 +1,86 @@
-from contextlib import contextmanager
-from datetime import datetime
-from sqlalchemy import create_engine, Column, BigInteger, String, Float, DateTime, ForeignKey, Boolean, text
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import create_engine, Column, BigInteger, Integer, String, Text, Float, Numeric, DateTime, ForeignKey, Boolean, text, func, cast, literal, update, delete, select, union_all, and_, or_, Index, UniqueConstraint
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.schema import CreateSchema
-from utils import AlchemyEncoder
-import json
+from metrics import ROWS_WRITTEN
+from utils import ColumnSerializer, to_cents
+import asyncio
 import os
 
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
 # Database connection setup
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is not set")
 
-engine = create_engine(DATABASE_URL)
+# Connection pool settings, shared by the sync and async engines
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+
+poolOptions = dict(
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
+
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"},
+    **poolOptions
+)
+
+# libpq URL parameters with an asyncpg equivalent; any other is dropped from the derived URL,
+# since the asyncpg dialect passes them straight to asyncpg.connect
+ASYNCPG_URL_PARAMETERS = {"sslmode": "ssl", "ssl": "ssl", "target_session_attrs": "target_session_attrs"}
+
+def _asyncpg_url(url: str):
+    url = make_url(url)
+    query = {}
+    for name, value in url.query.items():
+        if name in ASYNCPG_URL_PARAMETERS:
+            query[ASYNCPG_URL_PARAMETERS[name]] = value
+        else:
+            print(f"Ignoring database URL parameter {name} for the async engine")
+    return url.set(drivername="postgresql+asyncpg", query=query)
+
+# Async engine on asyncpg, derived from DATABASE_URL unless ASYNC_DATABASE_URL is set
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or _asyncpg_url(DATABASE_URL)
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        connect_args={"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}},
+        **poolOptions
+    )
+except ImportError:
+    # asyncpg or greenlet is not installed, async helpers fall back to the sync engine in a thread
+    async_engine = None
+    async_sessionmaker = None
 Base = declarative_base()
 
 class Settlement(Base):
     __tablename__ = 'Settlements'
-    __table_args__ = {'schema': 'expense_schema'}
+    __table_args__ = (
+        Index('ix_settlements_group_status', 'groupId', 'status'),
+        {'schema': 'expense_schema'}
+    )
     id = Column(BigInteger, primary_key=True)
+    groupId = Column(BigInteger, ForeignKey('expense_schema.Groups.id'))
     payerId = Column(String, ForeignKey('expense_schema.Users.tgId'))
     receiverId = Column(String, ForeignKey('expense_schema.Users.tgId'))
     amount = Column(Float)
@@ -66,35 +127,148 @@ class Group(Base):
     name = Column(String, nullable=False)
     description = Column(String)
     currency = Column(String, nullable=False)
+    version = Column(BigInteger, nullable=False, default=0)  # Bumped by every ledger and settlement write
     createdAt = Column(DateTime, default=datetime.utcnow)
     updatedAt = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     members = relationship("GroupMember", back_populates="group")
 
 class GroupMember(Base):
     __tablename__ = 'GroupMembers'
-    __table_args__ = {'schema': 'expense_schema'}
+    __table_args__ = (
+        UniqueConstraint('userId', 'groupId', name='uq_group_members_user_group'),
+        {'schema': 'expense_schema'}
+    )
     id = Column(BigInteger, primary_key=True)
     userId = Column(BigInteger, ForeignKey('expense_schema.Users.id'))
     groupId = Column(BigInteger, ForeignKey('expense_schema.Groups.id'))
     joinedAt = Column(DateTime, default=datetime.utcnow)
     isAdmin = Column(Boolean, default=False)
-    balance = Column(Float, default=0)
+    balance = Column(Float, default=0)  # Superseded by GroupBalance.paid, no longer maintained
     user = relationship("User", back_populates="groupMemberships")
     group = relationship("Group", back_populates="members")
     transactions = relationship("Transaction", back_populates="groupMember")
 
 class Transaction(Base):
     __tablename__ = 'Transactions'
-    __table_args__ = {'schema': 'expense_schema'}
+    __table_args__ = (
+        UniqueConstraint('sourceChatId', 'sourceMessageId', 'sourceItemIndex', name='uq_transactions_source_item'),
+        Index('ix_transactions_member_date', 'groupMemberId', 'date', 'id'),
+        {'schema': 'expense_schema'}
+    )
     id = Column(BigInteger, primary_key=True)
     groupMemberId = Column(BigInteger, ForeignKey('expense_schema.GroupMembers.id'))
     description = Column(String)
     amount = Column(Float)
     date = Column(DateTime)
+    sourceChatId = Column(String)  # Telegram chat the expense was extracted from
+    sourceMessageId = Column(BigInteger)  # Telegram message the expense was extracted from
+    sourceItemIndex = Column(Integer, nullable=False, default=0)  # Position among the expenses of that message
     createdAt = Column(DateTime, default=datetime.utcnow)
     updatedAt = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     groupMember = relationship("GroupMember", back_populates="transactions")
 
+class ProcessingCursor(Base):
+    __tablename__ = 'ProcessingCursors'
+    __table_args__ = {'schema': 'expense_schema'}
+    id = Column(BigInteger, primary_key=True)
+    groupTgId = Column(String, unique=True, nullable=False)
+    lastMessageId = Column(BigInteger, nullable=False, default=0)  # Telegram id of the last processed message
+    createdAt = Column(DateTime, default=datetime.utcnow)
+    updatedAt = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class GroupBalance(Base):
+    # Projection of the ledger, updated in the same transaction as every Transactions write
+    __tablename__ = 'GroupBalances'
+    __table_args__ = {'schema': 'expense_schema'}
+    groupId = Column(BigInteger, ForeignKey('expense_schema.Groups.id'), primary_key=True)
+    userId = Column(BigInteger, ForeignKey('expense_schema.Users.id'), primary_key=True)
+    paid = Column(Numeric(14, 2), nullable=False, default=0)
+    settled = Column(Numeric(14, 2), nullable=False, default=0)  # Completed settlements paid out minus received
+    updatedAt = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SpendAggregate(Base):
+    # Rollup of the ledger per member and time bucket, updated in the same transaction as every Transactions write
+    __tablename__ = 'SpendAggregates'
+    __table_args__ = {'schema': 'expense_schema'}
+    groupId = Column(BigInteger, ForeignKey('expense_schema.Groups.id'), primary_key=True)
+    granularity = Column(String, primary_key=True)  # One of SPEND_GRANULARITIES
+    bucketStart = Column(DateTime, primary_key=True)
+    userId = Column(BigInteger, ForeignKey('expense_schema.Users.id'), primary_key=True)
+    currency = Column(String, primary_key=True)
+    total = Column(Numeric(14, 2), nullable=False, default=0)
+    count = Column(Integer, nullable=False, default=0)
+    updatedAt = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ExtractionCacheEntry(Base):
+    # Parsed model outputs keyed by a hash of everything that went into the prompt
+    __tablename__ = 'ExtractionCache'
+    __table_args__ = {'schema': 'expense_schema'}
+    key = Column(String(64), primary_key=True)
+    model = Column(String, nullable=False)
+    output = Column(Text, nullable=False)  # ExpenseTrackingOutput as JSON
+    hits = Column(Integer, nullable=False, default=0)
+    createdAt = Column(DateTime, default=datetime.utcnow, index=True)
+    lastAccessedAt = Column(DateTime, default=datetime.utcnow, index=True)
+
+class StoredMessage(Base):
+    # Local copy of group messages, appended by the live ingestion handlers
+    __tablename__ = 'ChatMessages'
+    __table_args__ = (
+        UniqueConstraint('chatId', 'messageId', name='uq_chat_messages_chat_message'),
+        {'schema': 'expense_schema'}
+    )
+    id = Column(BigInteger, primary_key=True)
+    chatId = Column(BigInteger, nullable=False)  # Marked Telegram peer id
+    messageId = Column(BigInteger, nullable=False)
+    senderId = Column(BigInteger)
+    senderIsBot = Column(Boolean, default=False)
+    text = Column(Text)
+    date = Column(DateTime)
+    createdAt = Column(DateTime, default=datetime.utcnow)
+    updatedAt = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ChatParticipant(Base):
+    __tablename__ = 'ChatParticipants'
+    __table_args__ = {'schema': 'expense_schema'}
+    chatId = Column(BigInteger, primary_key=True)  # Marked Telegram peer id
+    userId = Column(BigInteger, primary_key=True)
+    isBot = Column(Boolean, default=False)
+    active = Column(Boolean, default=True)
+    updatedAt = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Idempotent upgrades for tables created before a column or constraint was added
+SCHEMA_UPGRADES = [
+    'ALTER TABLE expense_schema."Transactions" ADD COLUMN IF NOT EXISTS "sourceChatId" VARCHAR',
+    'ALTER TABLE expense_schema."Transactions" ADD COLUMN IF NOT EXISTS "sourceMessageId" BIGINT',
+    'ALTER TABLE expense_schema."Transactions" ADD COLUMN IF NOT EXISTS "sourceItemIndex" INTEGER NOT NULL DEFAULT 0',
+    # A message can state several expenses, so the source key includes the item
+    'ALTER TABLE expense_schema."Transactions" DROP CONSTRAINT IF EXISTS uq_transactions_source_message',
+    'DROP INDEX IF EXISTS expense_schema.uq_transactions_source_message',
+    'CREATE UNIQUE INDEX IF NOT EXISTS uq_transactions_source_item ON expense_schema."Transactions" ("sourceChatId", "sourceMessageId", "sourceItemIndex")',
+    # Fold duplicate memberships into the oldest row before enforcing uniqueness
+    '''WITH ranked AS (
+        SELECT id, MIN(id) OVER (PARTITION BY "userId", "groupId") AS "keepId" FROM expense_schema."GroupMembers"
+    )
+    UPDATE expense_schema."Transactions" t SET "groupMemberId" = ranked."keepId"
+    FROM ranked WHERE t."groupMemberId" = ranked.id AND ranked.id <> ranked."keepId"''',
+    '''WITH ranked AS (
+        SELECT id, MIN(id) OVER (PARTITION BY "userId", "groupId") AS "keepId" FROM expense_schema."GroupMembers"
+    ), duplicates AS (
+        DELETE FROM expense_schema."GroupMembers" gm USING ranked
+        WHERE gm.id = ranked.id AND ranked.id <> ranked."keepId"
+        RETURNING ranked."keepId", gm.balance
+    )
+    UPDATE expense_schema."GroupMembers" gm SET balance = gm.balance + merged.balance
+    FROM (SELECT "keepId", SUM(balance) AS balance FROM duplicates GROUP BY "keepId") merged
+    WHERE gm.id = merged."keepId"''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS uq_group_members_user_group ON expense_schema."GroupMembers" ("userId", "groupId")',
+    'ALTER TABLE expense_schema."Settlements" ADD COLUMN IF NOT EXISTS "groupId" BIGINT REFERENCES expense_schema."Groups" (id)',
+    'CREATE INDEX IF NOT EXISTS ix_settlements_group_status ON expense_schema."Settlements" ("groupId", status)',
+    'ALTER TABLE expense_schema."GroupBalances" ADD COLUMN IF NOT EXISTS settled NUMERIC(14, 2) NOT NULL DEFAULT 0',
+    'ALTER TABLE expense_schema."Groups" ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0',
+    'CREATE INDEX IF NOT EXISTS ix_transactions_member_date ON expense_schema."Transactions" ("groupMemberId", date, id)',
+]
+
 # Database initialization and session management
 def init_db():
     with engine.connect() as connection:
@@ -105,8 +279,29 @@ def init_db():
     
     Base.metadata.create_all(engine)
 
+    with engine.connect() as connection:
+        for statement in SCHEMA_UPGRADES:
+            connection.execute(text(statement))
+        connection.commit()
+
+    # Projections added to an existing database start empty; fill them from the ledger
+    with session_scope() as session:
+        # Workers starting together backfill once
+        session.execute(text("SELECT pg_advisory_xact_lock(hashtextextended('init_db:backfill', 0))"))
+        hasTransactions = session.query(select(Transaction.id).exists()).scalar()
+        if hasTransactions and not session.query(select(GroupBalance.groupId).exists()).scalar():
+            print("Backfilling member balances from the ledger")
+            rebuild_group_balances(session=session)
+        if hasTransactions and not session.query(select(SpendAggregate.groupId).exists()).scalar():
+            print("Backfilling spend aggregates from the ledger")
+            rebuild_spend_aggregates(session=session)
+
 Session = sessionmaker(bind=engine)
 
+# Column-only serialization of users for API responses
+serialize_user = ColumnSerializer(User)
+userColumns = [getattr(User, column) for column in serialize_user.columns]
+
 @contextmanager
 def session_scope():
     session = Session()
@@ -119,122 +314,364 @@ def session_scope():
     finally:
         session.close()
 
+AsyncSession = async_sessionmaker(bind=async_engine, expire_on_commit=False) if async_engine else None
+
+@asynccontextmanager
+async def async_session_scope():
+    session = AsyncSession()
+    try:
+        yield session
+        await session.commit()
+    except Exception as e:
+        await session.rollback()
+        raise e
+    finally:
+        await session.close()
+
+async def run_db(function, *args, **kwargs):
+    """
+    Run a database helper from async code without blocking the event loop.
+
+    Helpers take a `session` keyword, so on the async engine they run through
+    AsyncSession.run_sync; without asyncpg they run in a worker thread instead.
+    """
+    if async_engine is None:
+        return await asyncio.to_thread(function, *args, **kwargs)
+    async with async_session_scope() as session:
+        return await session.run_sync(lambda syncSession: function(*args, session=syncSession, **kwargs))
+
+# Cross-worker locks, held on a dedicated connection until released
+def try_acquire_chat_lock(chatId: str):
+    # Never blocks: returns the connection holding the lock, or None if another worker has it.
+    # AUTOCOMMIT keeps the connection from sitting idle in a transaction while the lock is held
+    connection = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    try:
+        acquired = connection.execute(
+            text("SELECT pg_try_advisory_lock(hashtextextended(:key, 0))"), {"key": f"process_messages:{chatId}"}
+        ).scalar()
+    except Exception:
+        connection.close()
+        raise
+    if not acquired:
+        connection.close()
+        return None
+    return connection
+
+def release_chat_lock(connection, chatId: str):
+    try:
+        connection.execute(text("SELECT pg_advisory_unlock(hashtextextended(:key, 0))"), {"key": f"process_messages:{chatId}"})
+    finally:
+        connection.close()
+
 # Helper functions for database operations
-def create_user(tgId: str, username: str, firstName: str, lastName: str, session=None):
-    def _create_user(session):
-        user = User(tgId=tgId, username=username, firstName=firstName, lastName=lastName)
-        session.add(user)
-        session.flush()
-        return user
+def _apply_balance_deltas(groupId: int, deltas: dict, session):
+    # Add the amounts paid per user to the balances projection in one statement
+    statement = insert(GroupBalance)
+    statement = statement.on_conflict_do_update(
+        index_elements=[GroupBalance.groupId, GroupBalance.userId],
+        set_={'paid': GroupBalance.paid + statement.excluded.paid, 'updatedAt': datetime.utcnow()}
+    )
+    session.execute(statement, [
+        {'groupId': groupId, 'userId': userId, 'paid': delta}
+        for userId, delta in deltas.items()
+    ])
+
+SPEND_GRANULARITIES = ('day', 'week', 'month')
+
+def spend_bucket_start(value: datetime, granularity: str) -> datetime:
+    # Weeks start on Monday, like date_trunc('week') in Postgres
+    day = datetime(value.year, value.month, value.day)
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+def _apply_spend_deltas(groupId: int, currency: str, rows: list, session):
+    # Add (userId, date, amount) rows to every bucket they fall in, in one statement
+    deltas = {}
+    for userId, date, amount in rows:
+        if date is None:
+            continue
+        for granularity in SPEND_GRANULARITIES:
+            key = (userId, granularity, spend_bucket_start(date, granularity))
+            total, count = deltas.get(key, (Decimal('0'), 0))
+            deltas[key] = (total + amount, count + 1)
+    if not deltas:
+        return
+
+    statement = insert(SpendAggregate)
+    statement = statement.on_conflict_do_update(
+        index_elements=[SpendAggregate.groupId, SpendAggregate.granularity, SpendAggregate.bucketStart,
+                        SpendAggregate.userId, SpendAggregate.currency],
+        set_={
+            'total': SpendAggregate.total + statement.excluded.total,
+            'count': SpendAggregate.count + statement.excluded.count,
+            'updatedAt': datetime.utcnow()
+        }
+    )
+    session.execute(statement, [
+        {'groupId': groupId, 'userId': userId, 'currency': currency, 'granularity': granularity,
+         'bucketStart': bucketStart, 'total': total, 'count': count}
+        for (userId, granularity, bucketStart), (total, count) in deltas.items()
+    ])
+    ROWS_WRITTEN.inc(len(deltas), table="SpendAggregates")
+
+def _spend_bucket_starts(dates, granularity: str):
+    # Vectorized spend_bucket_start over a pandas Series of datetimes
+    days = dates.dt.normalize()
+    if granularity == 'week':
+        return days - pd.to_timedelta(days.dt.weekday, unit='D')
+    if granularity == 'month':
+        return days.dt.to_period('M').dt.to_timestamp()
+    return days
+
+def rebuild_spend_aggregates(groupId: int = None, session=None):
+    """
+    Recompute the spend rollups from the Transactions ledger, for backfills.
+
+    Buckets are computed in memory with pandas when it is installed, otherwise by
+    Postgres with date_trunc.
+
+    :param groupId: Database id of the group to rebuild, or None for every group
+    """
+    def _rebuild_spend_aggregates(session):
+        clear = delete(SpendAggregate)
+        if groupId is not None:
+            clear = clear.where(SpendAggregate.groupId == groupId)
+        session.execute(clear)
+
+        def ledger(*columns):
+            statement = (
+                select(GroupMember.groupId, GroupMember.userId, Group.currency, *columns)
+                .join(GroupMember, GroupMember.id == Transaction.groupMemberId)
+                .join(Group, Group.id == GroupMember.groupId)
+                .where(Transaction.date.isnot(None))
+            )
+            return statement.where(GroupMember.groupId == groupId) if groupId is not None else statement
+
+        columns = [SpendAggregate.groupId, SpendAggregate.userId, SpendAggregate.currency, SpendAggregate.granularity,
+                   SpendAggregate.bucketStart, SpendAggregate.total, SpendAggregate.count]
+        if pd is None:
+            for granularity in SPEND_GRANULARITIES:
+                bucketStart = func.date_trunc(granularity, Transaction.date)
+                totals = ledger(literal(granularity), bucketStart, func.sum(cast(Transaction.amount, Numeric(14, 2))), func.count()).group_by(
+                    GroupMember.groupId, GroupMember.userId, Group.currency, bucketStart
+                )
+                session.execute(insert(SpendAggregate).from_select(columns, totals))
+            return
+
+        frame = pd.read_sql(ledger(Transaction.date, Transaction.amount), session.connection())
+        if frame.empty:
+            return
+        rows = []
+        for granularity in SPEND_GRANULARITIES:
+            frame['bucketStart'] = _spend_bucket_starts(frame['date'], granularity)
+            totals = frame.groupby(['groupId', 'userId', 'currency', 'bucketStart'], sort=False)['amount'].agg(total='sum', transactions='count').reset_index()
+            rows.extend(
+                {'groupId': int(row.groupId), 'userId': int(row.userId), 'currency': row.currency, 'granularity': granularity,
+                 'bucketStart': row.bucketStart.to_pydatetime(), 'total': round(float(row.total), 2), 'count': int(row.transactions)}
+                for row in totals.itertuples(index=False)
+            )
+        session.execute(insert(SpendAggregate), rows)
 
     if session:
-        return _create_user(session)
+        return _rebuild_spend_aggregates(session)
     else:
         with session_scope() as session:
-            return _create_user(session)
+            return _rebuild_spend_aggregates(session)
 
-def get_or_create_user(tgId: str, username: str, firstName: str, lastName: str, session=None):
-    def _get_or_create_user(session):
-        user = session.query(User).filter_by(tgId=tgId).first()
-        if not user:
-            user = create_user(tgId, username, firstName, lastName, session)
-        return user
+def get_spend_aggregates(groupId: int, granularity: str, memberTgId: str = None, dateFrom: datetime = None,
+                         dateTo: datetime = None, session=None):
+    def _get_spend_aggregates(session):
+        # Buckets overlapping the range, read straight from the rollup
+        statement = (
+            select(User.tgId, SpendAggregate.currency, SpendAggregate.bucketStart, SpendAggregate.total, SpendAggregate.count)
+            .join(User, User.id == SpendAggregate.userId)
+            .where(SpendAggregate.groupId == groupId, SpendAggregate.granularity == granularity)
+            .order_by(SpendAggregate.bucketStart, User.tgId, SpendAggregate.currency)
+        )
+        if memberTgId is not None:
+            statement = statement.where(User.tgId == memberTgId)
+        if dateFrom is not None:
+            statement = statement.where(SpendAggregate.bucketStart >= spend_bucket_start(dateFrom, granularity))
+        if dateTo is not None:
+            statement = statement.where(SpendAggregate.bucketStart < dateTo)
+        return [
+            {'memberTgId': tgId, 'currency': currency, 'bucketStart': bucketStart.isoformat(), 'total': float(total), 'count': count}
+            for tgId, currency, bucketStart, total, count in session.execute(statement)
+        ]
 
     if session:
-        return _get_or_create_user(session)
+        return _get_spend_aggregates(session)
     else:
         with session_scope() as session:
-            return _get_or_create_user(session)
+            return _get_spend_aggregates(session)
+
+def rebuild_group_balances(groupId: int = None, session=None):
+    """
+    Recompute the balances projection from the Transactions ledger and the completed settlements.
+
+    :param groupId: Database id of the group to rebuild, or None for every group
+    """
+    def _rebuild_group_balances(session):
+        totals = (
+            select(GroupMember.groupId, GroupMember.userId, func.sum(cast(Transaction.amount, Numeric(14, 2))))
+            .join(Transaction, Transaction.groupMemberId == GroupMember.id)
+            .group_by(GroupMember.groupId, GroupMember.userId)
+        )
+        clear = delete(GroupBalance)
+        if groupId is not None:
+            totals = totals.where(GroupMember.groupId == groupId)
+            clear = clear.where(GroupBalance.groupId == groupId)
+        session.execute(clear)
+        session.execute(
+            insert(GroupBalance).from_select([GroupBalance.groupId, GroupBalance.userId, GroupBalance.paid], totals)
+        )
 
-def create_group(name: str, description: str, currency: str, tgId: str, session=None):
-    def _create_group(session):
-        group = Group(name=name, description=description, currency=currency, tgId=tgId)
-        session.add(group)
-        session.flush()
-        return group
+        amount = cast(Settlement.amount, Numeric(14, 2))
+        transfers = union_all(
+            select(Settlement.groupId, User.id.label('userId'), amount.label('amount'))
+            .join(User, User.tgId == Settlement.payerId).where(Settlement.status == 'completed'),
+            select(Settlement.groupId, User.id.label('userId'), (-amount).label('amount'))
+            .join(User, User.tgId == Settlement.receiverId).where(Settlement.status == 'completed')
+        ).subquery()
+        settled = (
+            select(transfers.c.groupId, transfers.c.userId, func.sum(transfers.c.amount))
+            .where(transfers.c.groupId.isnot(None))
+            .group_by(transfers.c.groupId, transfers.c.userId)
+        )
+        if groupId is not None:
+            settled = settled.where(transfers.c.groupId == groupId)
+        statement = insert(GroupBalance).from_select([GroupBalance.groupId, GroupBalance.userId, GroupBalance.settled], settled)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[GroupBalance.groupId, GroupBalance.userId],
+            set_={'settled': statement.excluded.settled}
+        ))
 
     if session:
-        return _create_group(session)
+        return _rebuild_group_balances(session)
     else:
         with session_scope() as session:
-            return _create_group(session)
-        
-def update_group(tgId: str, name: str, description: str, currency: str, session=None):
-    def _update_group(session):
-        group = session.query(Group).filter_by(tgId=tgId).first()
-        if group:
-            group.name = name
-            group.description = description
-            group.currency = currency
-            group.updatedAt = datetime.utcnow()
-            session.flush()
-        return group
+            return _rebuild_group_balances(session)
+
+def _bump_group_versions(groupIds, session):
+    # Tells cached summaries in every worker that the group changed
+    session.execute(
+        update(Group).where(Group.id.in_(list(groupIds))).values(version=Group.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+def get_group_version(groupTgId: str, session=None):
+    def _get_group_version(session):
+        return session.execute(select(Group.version).where(Group.tgId == groupTgId)).scalar()
 
     if session:
-        return _update_group(session)
+        return _get_group_version(session)
     else:
         with session_scope() as session:
-            return _update_group(session)		
+            return _get_group_version(session)
+
+def create_settlements(groupId: int, settlements: list, session=None):
+    def _create_settlements(session):
+        # The new settlements are computed from the whole ledger, so they replace the pending
+        # ones. Transfers that did not change keep their row, and the id clients already have
+        pending = {}
+        for row in session.execute(
+            select(Settlement.id, Settlement.payerId, Settlement.receiverId, Settlement.amount)
+            .where(Settlement.groupId == groupId, Settlement.status == 'pending')
+            .order_by(Settlement.id)
+            .with_for_update()
+        ):
+            pending.setdefault((row.payerId, row.receiverId, to_cents(row.amount)), []).append(row.id)
 
-def add_user_to_group(userId: int, groupId: int, isAdmin: bool = False, session=None):
-    def _add_user_to_group(session):
-        groupMember = GroupMember(userId=userId, groupId=groupId, isAdmin=isAdmin)
-        session.add(groupMember)
-        session.flush()
-        return groupMember
+        added = []
+        for settlement in settlements:
+            matches = pending.get((settlement['fromUserId'], settlement['toUserId'], to_cents(settlement['amount'])))
+            if matches:
+                matches.pop(0)
+            else:
+                added.append(settlement)
+
+        stale = [settlementId for ids in pending.values() for settlementId in ids]
+        if stale:
+            session.execute(
+                update(Settlement)
+                .where(Settlement.id.in_(stale), Settlement.status == 'pending')
+                .values(status='cancelled', updatedAt=datetime.utcnow())
+                .execution_options(synchronize_session=False)
+            )
+        if stale or added:
+            _bump_group_versions([groupId], session)
+        if added:
+            ROWS_WRITTEN.inc(len(added), table="Settlements")
+            session.execute(insert(Settlement), [
+                {'groupId': groupId, 'payerId': settlement['fromUserId'], 'receiverId': settlement['toUserId'],
+                 'amount': settlement['amount'], 'status': 'pending'}
+                for settlement in added
+            ])
 
     if session:
-        return _add_user_to_group(session)
+        return _create_settlements(session)
     else:
         with session_scope() as session:
-            return _add_user_to_group(session)
+            return _create_settlements(session)
 
-def create_transaction(groupMemberId: int, description: str, amount: float, date: datetime, session=None):
-    def _create_transaction(session):
-        transaction = Transaction(groupMemberId=groupMemberId, description=description, amount=amount, date=date)
-        session.add(transaction)
-        
-        groupMember = session.query(GroupMember).get(groupMemberId)
-        groupMember.balance += amount
-        
-        session.flush()
-        return transaction
+def get_group_balance(groupId: int, session=None):
+    def _get_group_balance(session):
+        # Members without any recorded payment still take part in the split. Completed
+        # settlements sum to zero over the group, so adding them leaves each share unchanged
+        rows = (
+            session.query(User.tgId, func.coalesce(GroupBalance.paid + GroupBalance.settled, 0))
+            .select_from(GroupMember)
+            .join(User, User.id == GroupMember.userId)
+            .outerjoin(GroupBalance, (GroupBalance.groupId == GroupMember.groupId) & (GroupBalance.userId == GroupMember.userId))
+            .filter(GroupMember.groupId == groupId)
+        )
+        return {tgId: Decimal(paid) for tgId, paid in rows}
 
     if session:
-        return _create_transaction(session)
+        return _get_group_balance(session)
     else:
         with session_scope() as session:
-            return _create_transaction(session)
+            return _get_group_balance(session)
+        
 
-def create_settlement(payerTgId: str, receiverTgId: str, amount: float, session=None):
-    def _create_settlement(session):
-        settlement = Settlement(payerId=payerTgId, receiverId=receiverTgId, amount=amount, status='pending')
-        session.add(settlement)
-        session.flush()
-        return settlement
+def get_group_paid(groupId: int, session=None):
+    def _get_group_paid(session):
+        # What each member paid according to the ledger, settlements left out
+        rows = (
+            session.query(User.tgId, func.coalesce(GroupBalance.paid, 0))
+            .select_from(GroupMember)
+            .join(User, User.id == GroupMember.userId)
+            .outerjoin(GroupBalance, (GroupBalance.groupId == GroupMember.groupId) & (GroupBalance.userId == GroupMember.userId))
+            .filter(GroupMember.groupId == groupId)
+        )
+        return {tgId: Decimal(paid) for tgId, paid in rows}
 
     if session:
-        return _create_settlement(session)
+        return _get_group_paid(session)
     else:
         with session_scope() as session:
-            return _create_settlement(session)
+            return _get_group_paid(session)
 
-def get_group_balance(groupId: int, session=None):
-    def _get_group_balance(session):
-        groupMembers = session.query(GroupMember).filter_by(groupId=groupId).all()
-        return {member.user.tgId: member.balance for member in groupMembers}
+def get_group_from_tgId(tgId: str, session=None):
+    def _get_group_from_tgId(session):
+        group = session.execute(
+            select(Group.id, Group.tgId, Group.name, Group.description, Group.currency).where(Group.tgId == tgId)
+        ).first()
+        return dict(group._mapping) if group else None
 
     if session:
-        return _get_group_balance(session)
+        return _get_group_from_tgId(session)
     else:
         with session_scope() as session:
-            return _get_group_balance(session)
-        
+            return _get_group_from_tgId(session)
 
 def get_user_from_tgId(tgId: str, session=None):
     def _get_user_from_tgId(session):
-        user = session.query(User).filter_by(tgId=tgId).first()
-        return json.loads(json.dumps(user, cls=AlchemyEncoder))
+        user = session.execute(select(*userColumns).where(User.tgId == tgId)).first()
+        return serialize_user(user) if user else None
 
     if session:
         return _get_user_from_tgId(session)
@@ -243,14 +680,98 @@ def get_user_from_tgId(tgId: str, session=None):
             return _get_user_from_tgId(session)
         
 
+def get_users_by_tgIds(tgIds: list, session=None):
+    def _get_users_by_tgIds(session):
+        # One query for all users, returned in the order of tgIds
+        rows = session.execute(select(*userColumns).where(User.tgId.in_(tgIds))) if tgIds else []
+        users = {row.tgId: serialize_user(row) for row in rows}
+        return [users.get(str(tgId)) for tgId in tgIds]
+
+    if session:
+        return _get_users_by_tgIds(session)
+    else:
+        with session_scope() as session:
+            return _get_users_by_tgIds(session)
+
+def get_group_member_tgIds(groupId: int, session=None):
+    def _get_group_member_tgIds(session):
+        rows = session.query(User.tgId).join(GroupMember, GroupMember.userId == User.id).filter(GroupMember.groupId == groupId).order_by(GroupMember.id)
+        return [tgId for tgId, in rows]
+
+    if session:
+        return _get_group_member_tgIds(session)
+    else:
+        with session_scope() as session:
+            return _get_group_member_tgIds(session)
+
+def get_group_summary(groupTgId: str, session=None):
+    def _get_group_summary(session):
+        dbGroup = session.query(Group).filter_by(tgId=groupTgId).first()
+        if not dbGroup:
+            return None
+        return {
+            "group": {
+                "tgId": dbGroup.tgId,
+                "name": dbGroup.name,
+                "description": dbGroup.description,
+                "currency": dbGroup.currency,
+                "members": get_users_by_tgIds(get_group_member_tgIds(dbGroup.id, session=session), session=session)
+            },
+            "settlements": get_settlements(groupTgId, session=session)
+        }
+
+    if session:
+        return _get_group_summary(session)
+    else:
+        with session_scope() as session:
+            return _get_group_summary(session)
+
+# Largest IN list sent in one statement when completing settlements
+SETTLEMENT_BATCH_SIZE = 1000
+
+def _complete_pending_settlements(session, settlementIds: list, groupId=None):
+    # Mark pending settlements completed batch by batch and move their amounts into the balances
+    completed = []
+    for start in range(0, len(settlementIds), SETTLEMENT_BATCH_SIZE):
+        statement = (
+            update(Settlement)
+            .where(Settlement.id.in_(settlementIds[start:start + SETTLEMENT_BATCH_SIZE]), Settlement.status == 'pending')
+            .values(status='completed', updatedAt=datetime.utcnow())
+            .returning(Settlement.id, Settlement.groupId, Settlement.payerId, Settlement.receiverId,
+                       Settlement.amount, Settlement.status, Settlement.updatedAt)
+            .execution_options(synchronize_session=False)
+        )
+        if groupId is not None:
+            statement = statement.where(Settlement.groupId == groupId)
+        completed.extend(session.execute(statement).all())
+
+    groupIds = {row.groupId for row in completed if row.groupId is not None}
+    if groupIds:
+        _bump_group_versions(groupIds, session)
+
+    deltas = {}
+    for row in completed:
+        if row.groupId is None:
+            continue
+        amount = Decimal(str(row.amount))
+        deltas[(row.groupId, row.payerId)] = deltas.get((row.groupId, row.payerId), Decimal('0')) + amount
+        deltas[(row.groupId, row.receiverId)] = deltas.get((row.groupId, row.receiverId), Decimal('0')) - amount
+    if deltas:
+        userIds = dict(session.execute(select(User.tgId, User.id).where(User.tgId.in_({tgId for _, tgId in deltas}))).all())
+        statement = insert(GroupBalance)
+        statement = statement.on_conflict_do_update(
+            index_elements=[GroupBalance.groupId, GroupBalance.userId],
+            set_={'settled': GroupBalance.settled + statement.excluded.settled, 'updatedAt': datetime.utcnow()}
+        )
+        session.execute(statement, [
+            {'groupId': rowGroupId, 'userId': userIds[tgId], 'settled': delta}
+            for (rowGroupId, tgId), delta in deltas.items() if tgId in userIds
+        ])
+    return completed
+
 def complete_settlements(settlement_ids: list, session=None):
     def _complete_settlements(session):
-        updated_settlements = session.query(Settlement).filter(Settlement.id.in_(settlement_ids)).update(
-            {Settlement.status: 'completed', Settlement.updatedAt: datetime.utcnow()},
-            synchronize_session=False
-        )
-        session.flush()
-        return updated_settlements
+        return len(_complete_pending_settlements(session, list(settlement_ids)))
 
     if session:
         return _complete_settlements(session)
@@ -258,41 +779,429 @@ def complete_settlements(settlement_ids: list, session=None):
         with session_scope() as session:
             return _complete_settlements(session)		
         
+def complete_group_settlements(groupTgId: str, settlementIds: list, session=None):
+    """
+    Complete pending settlements of one group and apply them to the member balances.
+
+    Ids that cannot be completed are reported with the reason: not_found,
+    other_group, or their current status (completed, cancelled). Large batches are
+    sent in chunks of SETTLEMENT_BATCH_SIZE within the same transaction.
+
+    :param groupTgId: Telegram id of the group
+    :param settlementIds: Ids of the settlements to complete
+    :return: Tuple of the completed settlements and the rejected ids with their reason,
+        or None if the group does not exist
+    """
+    def _complete_group_settlements(session):
+        groupId = session.execute(select(Group.id).where(Group.tgId == groupTgId)).scalar()
+        if groupId is None:
+            return None
+        completed = [
+            {
+                "id": row.id,
+                "fromUserId": row.payerId,
+                "toUserId": row.receiverId,
+                "amount": float(row.amount),
+                "status": row.status,
+                "updatedAt": row.updatedAt.isoformat()
+            }
+            for row in _complete_pending_settlements(session, list(settlementIds), groupId)
+        ]
+
+        completedIds = {settlement["id"] for settlement in completed}
+        unapplied = [settlementId for settlementId in dict.fromkeys(settlementIds) if settlementId not in completedIds]
+        found = {}
+        for start in range(0, len(unapplied), SETTLEMENT_BATCH_SIZE):
+            found.update({
+                row.id: row for row in session.execute(
+                    select(Settlement.id, Settlement.groupId, Settlement.status)
+                    .where(Settlement.id.in_(unapplied[start:start + SETTLEMENT_BATCH_SIZE]))
+                )
+            })
+        rejected = []
+        for settlementId in unapplied:
+            row = found.get(settlementId)
+            if row is None:
+                reason = "not_found"
+            elif row.groupId != groupId:
+                reason = "other_group"
+            else:
+                reason = row.status
+            rejected.append({"id": settlementId, "reason": reason})
+        return completed, rejected
+
+    if session:
+        return _complete_group_settlements(session)
+    else:
+        with session_scope() as session:
+            return _complete_group_settlements(session)
+
 def get_settlements(groupTgId: str, session=None):
     def _get_settlements(session):
-        # First, find the Group by its telegram ID
-		
-        group = session.query(Group).filter_by(tgId=groupTgId).first()
-        if not group:
-            return []  # Return empty list if group not found
-
-        # Get all group members for the given group
-        group_members = session.query(GroupMember).filter_by(groupId=group.id).all()
-        
-        # Extract user IDs from group members
-        user_ids = [member.userId for member in group_members]
-        
-        # Query settlements where either payer or receiver is in the group
-        settlements = session.query(Settlement).join(User, 
-            ((Settlement.payerId == User.tgId) | (Settlement.receiverId == User.tgId))
-        ).filter(User.id.in_(user_ids), Settlement.status == 'pending').all()
+        # Pending settlements of the group, served by the (groupId, status) index
+        groupId = select(Group.id).where(Group.tgId == groupTgId).scalar_subquery()
+        rows = session.execute(
+            select(Settlement.id, Settlement.payerId, Settlement.receiverId, Settlement.amount, Settlement.status)
+            .where(Settlement.groupId == groupId, Settlement.status == 'pending')
+            .order_by(Settlement.id)
+        )
         
-        # Convert to the desired format
-        formatted_settlements = [
+        return [
             {
-                "id": settlement.id,
-                "fromUserId": settlement.payerId,
-                "toUserId": settlement.receiverId,
-                "amount": float(settlement.amount),  # Convert Decimal to float
-                "status": settlement.status
+                "id": row.id,
+                "fromUserId": row.payerId,
+                "toUserId": row.receiverId,
+                "amount": float(row.amount),  # Convert Decimal to float
+                "status": row.status
             }
-            for settlement in settlements
+            for row in rows
         ]
-        
-        return formatted_settlements
 
     if session:
         return _get_settlements(session)
     else:
         with session_scope() as session:
-            return _get_settlements(session)
\ No newline at end of file
+            return _get_settlements(session)
+
+def _group_transactions_query(groupId: int, memberTgId: str = None, dateFrom: datetime = None, dateTo: datetime = None):
+    # Newest first; the (groupMemberId, date, id) index serves each member's range in this order
+    statement = (
+        select(Transaction.id, User.tgId.label('memberTgId'), Transaction.description, Transaction.amount,
+               Transaction.date, Transaction.sourceMessageId)
+        .join(GroupMember, GroupMember.id == Transaction.groupMemberId)
+        .join(User, User.id == GroupMember.userId)
+        .where(GroupMember.groupId == groupId)
+        .order_by(Transaction.date.desc().nulls_last(), Transaction.id.desc())
+    )
+    if memberTgId is not None:
+        statement = statement.where(User.tgId == memberTgId)
+    if dateFrom is not None:
+        statement = statement.where(Transaction.date >= dateFrom)
+    if dateTo is not None:
+        statement = statement.where(Transaction.date < dateTo)
+    return statement
+
+def _transaction_row(row) -> dict:
+    return {
+        'id': row.id,
+        'memberTgId': row.memberTgId,
+        'description': row.description,
+        'amount': row.amount,
+        'date': row.date.isoformat() if row.date else None,
+        'sourceMessageId': row.sourceMessageId
+    }
+
+def get_group_transactions(groupId: int, memberTgId: str = None, dateFrom: datetime = None, dateTo: datetime = None,
+                           after: tuple = None, limit: int = 100, session=None):
+    """
+    Read one page of a group's transactions, newest first, with keyset pagination.
+
+    :param groupId: Database id of the group
+    :param memberTgId: Only transactions paid by this member
+    :param dateFrom: Only transactions dated on or after this
+    :param dateTo: Only transactions dated before this
+    :param after: (date, id) of the last transaction of the previous page
+    :param limit: Page size
+    :return: Tuple of the page and the (date, id) key to continue from, or None on the last page
+    """
+    def _get_group_transactions(session):
+        statement = _group_transactions_query(groupId, memberTgId, dateFrom, dateTo)
+        if after is not None:
+            afterDate, afterId = after
+            # Undated transactions sort last
+            if afterDate is None:
+                statement = statement.where(Transaction.date.is_(None), Transaction.id < afterId)
+            else:
+                statement = statement.where(or_(
+                    Transaction.date < afterDate,
+                    and_(Transaction.date == afterDate, Transaction.id < afterId),
+                    Transaction.date.is_(None)
+                ))
+        rows = session.execute(statement.limit(limit + 1)).all()
+        if len(rows) <= limit:
+            return [_transaction_row(row) for row in rows], None
+        last = rows[limit - 1]
+        return [_transaction_row(row) for row in rows[:limit]], (last.date, last.id)
+
+    if session:
+        return _get_group_transactions(session)
+    else:
+        with session_scope() as session:
+            return _get_group_transactions(session)
+
+def iter_group_transactions(groupId: int, memberTgId: str = None, dateFrom: datetime = None, dateTo: datetime = None,
+                            batchSize: int = 1000):
+    """
+    Yield all matching transactions of a group, newest first, through a server-side cursor.
+
+    Only batchSize rows are held in memory at a time. The session stays open until
+    the generator is exhausted or closed.
+    """
+    with session_scope() as session:
+        statement = _group_transactions_query(groupId, memberTgId, dateFrom, dateTo)
+        rows = session.execute(statement.execution_options(stream_results=True, yield_per=batchSize))
+        for row in rows:
+            yield _transaction_row(row)
+
+def get_processing_cursor(groupTgId: str, session=None):
+    def _get_processing_cursor(session):
+        lastMessageId = session.query(ProcessingCursor.lastMessageId).filter_by(groupTgId=groupTgId).scalar()
+        return lastMessageId or 0
+
+    if session:
+        return _get_processing_cursor(session)
+    else:
+        with session_scope() as session:
+            return _get_processing_cursor(session)
+
+def update_processing_cursor(groupTgId: str, lastMessageId: int, session=None):
+    def _update_processing_cursor(session):
+        # Never move the cursor backwards, even if two runs finish out of order
+        statement = insert(ProcessingCursor).values(groupTgId=groupTgId, lastMessageId=lastMessageId)
+        statement = statement.on_conflict_do_update(
+            index_elements=[ProcessingCursor.groupTgId],
+            set_={
+                'lastMessageId': func.greatest(ProcessingCursor.lastMessageId, statement.excluded.lastMessageId),
+                'updatedAt': datetime.utcnow()
+            }
+        )
+        session.execute(statement)
+
+    if session:
+        return _update_processing_cursor(session)
+    else:
+        with session_scope() as session:
+            return _update_processing_cursor(session)
+
+def bulk_save_expense_output(output: dict, sourceChatId: str, session=None):
+    """
+    Persist one extraction result in a fixed number of statements.
+
+    Upserts the group, its users and memberships, inserts the transactions not seen
+    before and adds their amounts to the balances projection and the spend rollups in
+    one aggregated upsert each.
+
+    :param output: Extraction result as returned by ExpenseTrackingOutput.model_dump()
+    :param sourceChatId: Telegram chat the messages were read from, also the group's tgId
+    :return: Database id of the group
+    """
+    def _bulk_save_expense_output(session):
+        groupData = output['group']
+        # The group is keyed on the chat that was read, not on the id the model echoes back
+        statement = insert(Group).values(
+            tgId=sourceChatId, name=groupData['name'],
+            description=groupData['description'], currency=groupData['currency']
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[Group.tgId],
+            set_={
+                'name': statement.excluded.name,
+                'description': statement.excluded.description,
+                'currency': statement.excluded.currency,
+                'version': Group.version + 1,
+                'updatedAt': datetime.utcnow()
+            }
+        )
+        groupId = session.execute(statement.returning(Group.id)).scalar_one()
+        ROWS_WRITTEN.inc(table="Groups")
+
+        members = {member['tgId']: member for member in groupData['members']}
+        if not members:
+            return groupId
+
+        # DO UPDATE (rather than DO NOTHING) so existing users are returned as well
+        statement = insert(User)
+        statement = statement.on_conflict_do_update(
+            index_elements=[User.tgId],
+            set_={
+                'username': func.coalesce(statement.excluded.username, User.username),
+                'firstName': func.coalesce(statement.excluded.firstName, User.firstName),
+                'lastName': func.coalesce(statement.excluded.lastName, User.lastName)
+            }
+        ).returning(User.id, User.tgId)
+        userIds = {
+            row.tgId: row.id
+            for row in session.execute(statement, [
+                {'tgId': tgId, 'username': member['username'], 'firstName': member['firstName'], 'lastName': member['lastName']}
+                for tgId, member in members.items()
+            ])
+        }
+        ROWS_WRITTEN.inc(len(userIds), table="Users")
+
+        statement = insert(GroupMember)
+        statement = statement.on_conflict_do_update(
+            index_elements=[GroupMember.userId, GroupMember.groupId],
+            set_={'isAdmin': GroupMember.isAdmin}
+        ).returning(GroupMember.id, GroupMember.userId)
+        groupMemberIds = {
+            row.userId: row.id
+            for row in session.execute(statement, [{'userId': userId, 'groupId': groupId} for userId in userIds.values()])
+        }
+        ROWS_WRITTEN.inc(len(groupMemberIds), table="GroupMembers")
+
+        # Number the expenses of each message in a content order, so the same extraction
+        # always gives the same keys whatever order the model listed them in
+        byMessage = {}
+        for tgId, member in members.items():
+            for transaction in member['transactions']:
+                byMessage.setdefault(transaction['messageId'], []).append((tgId, transaction))
+        transactionRows = [
+            {
+                'groupMemberId': groupMemberIds[userIds[tgId]],
+                'description': transaction['description'],
+                'amount': transaction['amount'],
+                'date': transaction['date'],
+                'sourceChatId': sourceChatId,
+                'sourceMessageId': messageId,
+                'sourceItemIndex': index
+            }
+            for messageId, items in byMessage.items()
+            for index, (tgId, transaction) in enumerate(
+                sorted(items, key=lambda item: (item[0], item[1]['amount'], item[1]['description'] or ''))
+            )
+        ]
+        if transactionRows:
+            statement = insert(Transaction).on_conflict_do_nothing(
+                index_elements=[Transaction.sourceChatId, Transaction.sourceMessageId, Transaction.sourceItemIndex]
+            ).returning(Transaction.groupMemberId, Transaction.amount, Transaction.date)
+
+            # Only rows actually inserted count towards the balances and the rollups
+            userIdsByMember = {groupMemberId: userId for userId, groupMemberId in groupMemberIds.items()}
+            deltas = {}
+            spendRows = []
+            for row in session.execute(statement, transactionRows):
+                userId = userIdsByMember[row.groupMemberId]
+                amount = Decimal(str(row.amount))
+                deltas[userId] = deltas.get(userId, Decimal('0')) + amount
+                spendRows.append((userId, row.date, amount))
+            ROWS_WRITTEN.inc(len(spendRows), table="Transactions")
+
+            if deltas:
+                _apply_balance_deltas(groupId, deltas, session)
+                _apply_spend_deltas(groupId, groupData['currency'], spendRows, session)
+
+        return groupId
+
+    if session:
+        return _bulk_save_expense_output(session)
+    else:
+        with session_scope() as session:
+            return _bulk_save_expense_output(session)
+
+def get_cached_extraction(key: str, maxAge: int, session=None):
+    def _get_cached_extraction(session):
+        # Reading an entry refreshes it for the size-based eviction
+        statement = (
+            update(ExtractionCacheEntry)
+            .where(ExtractionCacheEntry.key == key, ExtractionCacheEntry.createdAt >= datetime.utcnow() - timedelta(seconds=maxAge))
+            .values(hits=ExtractionCacheEntry.hits + 1, lastAccessedAt=datetime.utcnow())
+            .returning(ExtractionCacheEntry.output)
+            .execution_options(synchronize_session=False)
+        )
+        return session.execute(statement).scalar()
+
+    if session:
+        return _get_cached_extraction(session)
+    else:
+        with session_scope() as session:
+            return _get_cached_extraction(session)
+
+def store_cached_extraction(key: str, model: str, output: str, maxAge: int, maxEntries: int, session=None):
+    def _store_cached_extraction(session):
+        statement = insert(ExtractionCacheEntry).values(key=key, model=model, output=output)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[ExtractionCacheEntry.key],
+            set_={'output': statement.excluded.output, 'createdAt': datetime.utcnow(), 'lastAccessedAt': datetime.utcnow()}
+        ))
+
+        # Evict expired entries, then the least recently used ones beyond the size limit
+        session.execute(delete(ExtractionCacheEntry).where(ExtractionCacheEntry.createdAt < datetime.utcnow() - timedelta(seconds=maxAge)))
+        overflow = select(ExtractionCacheEntry.key).order_by(ExtractionCacheEntry.lastAccessedAt.desc()).offset(maxEntries)
+        session.execute(delete(ExtractionCacheEntry).where(ExtractionCacheEntry.key.in_(overflow)))
+
+    if session:
+        return _store_cached_extraction(session)
+    else:
+        with session_scope() as session:
+            return _store_cached_extraction(session)
+
+def store_chat_messages(messages: list, session=None):
+    def _store_chat_messages(session):
+        if not messages:
+            return
+        # Re-storing a message (an edit, or an overlap with a backfill) refreshes its text
+        statement = insert(StoredMessage)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[StoredMessage.chatId, StoredMessage.messageId],
+            set_={'text': statement.excluded.text, 'updatedAt': datetime.utcnow()}
+        ), messages)
+
+    if session:
+        return _store_chat_messages(session)
+    else:
+        with session_scope() as session:
+            return _store_chat_messages(session)
+
+def get_stored_messages(chatId: int, minMessageId: int = 0, session=None):
+    def _get_stored_messages(session):
+        rows = session.execute(
+            select(StoredMessage.messageId, StoredMessage.senderId, StoredMessage.senderIsBot, StoredMessage.text, StoredMessage.date)
+            .where(StoredMessage.chatId == chatId, StoredMessage.messageId > minMessageId)
+            .order_by(StoredMessage.messageId)
+        )
+        return rows.all()
+
+    if session:
+        return _get_stored_messages(session)
+    else:
+        with session_scope() as session:
+            return _get_stored_messages(session)
+
+def store_chat_participants(chatId: int, participants: list, active: bool = True, session=None):
+    def _store_chat_participants(session):
+        if not participants:
+            return
+        statement = insert(ChatParticipant)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[ChatParticipant.chatId, ChatParticipant.userId],
+            set_={'isBot': statement.excluded.isBot, 'active': statement.excluded.active, 'updatedAt': datetime.utcnow()}
+        ), [
+            {'chatId': chatId, 'userId': userId, 'isBot': isBot, 'active': active}
+            for userId, isBot in participants
+        ])
+
+    if session:
+        return _store_chat_participants(session)
+    else:
+        with session_scope() as session:
+            return _store_chat_participants(session)
+
+def get_chat_backlogs(chatIds: list, session=None):
+    def _get_chat_backlogs(session):
+        # Stored messages past each chat's processing cursor
+        rows = session.execute(
+            select(StoredMessage.chatId, func.count())
+            .outerjoin(ProcessingCursor, ProcessingCursor.groupTgId == cast(StoredMessage.chatId, String))
+            .where(StoredMessage.chatId.in_(chatIds), StoredMessage.messageId > func.coalesce(ProcessingCursor.lastMessageId, 0))
+            .group_by(StoredMessage.chatId)
+        )
+        backlogs = {chatId: 0 for chatId in chatIds}
+        backlogs.update({chatId: count for chatId, count in rows})
+        return backlogs
+
+    if session:
+        return _get_chat_backlogs(session)
+    else:
+        with session_scope() as session:
+            return _get_chat_backlogs(session)
+
+def get_chat_participant_ids(chatId: int, session=None):
+    def _get_chat_participant_ids(session):
+        rows = session.query(ChatParticipant.userId).filter_by(chatId=chatId, active=True, isBot=False).order_by(ChatParticipant.userId)
+        return [userId for userId, in rows]
+
+    if session:
+        return _get_chat_participant_ids(session)
+    else:
+        with session_scope() as session:
+            return _get_chat_participant_ids(session)
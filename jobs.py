@@ -0,0 +1,95 @@
+import asyncio
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+from config import JOB_WORKERS, JOB_RESULT_TTL
+
+
+class JobManager:
+	"""
+	Run chat analyses in a pool of background workers.
+
+	Jobs for the same chat never run concurrently, and submitting a chat that
+	already has a queued or running job returns that job instead of a new one.
+	"""
+
+	def __init__(self, handler: Callable[[int], Awaitable], workers: int = JOB_WORKERS, ttl: int = JOB_RESULT_TTL):
+		self.handler = handler
+		self.workers = workers
+		self.ttl = ttl
+		self.jobs: Dict[str, dict] = {}
+		self.queue: asyncio.Queue = asyncio.Queue()
+		self._active: Dict[int, str] = {}
+		self._chat_locks: Dict[int, asyncio.Lock] = {}
+		self._tasks = []
+
+	def start(self):
+		if not self._tasks:
+			self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+	async def stop(self):
+		for task in self._tasks:
+			task.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		self._tasks = []
+
+	def submit(self, chatId: int) -> dict:
+		self._prune()
+		activeJobId = self._active.get(chatId)
+		if activeJobId:
+			return self.jobs[activeJobId]
+
+		job = {
+			"id": uuid.uuid4().hex,
+			"chatId": chatId,
+			"status": "queued",
+			"result": None,
+			"error": None,
+			"createdAt": time.time(),
+			"startedAt": None,
+			"finishedAt": None
+		}
+		self.jobs[job["id"]] = job
+		self._active[chatId] = job["id"]
+		self.queue.put_nowait(job["id"])
+		return job
+
+	def get(self, jobId: str) -> Optional[dict]:
+		self._prune()
+		return self.jobs.get(jobId)
+
+	async def _worker(self):
+		while True:
+			jobId = await self.queue.get()
+			job = self.jobs.get(jobId)
+			try:
+				if job is not None:
+					await self._run(job)
+			finally:
+				self.queue.task_done()
+
+	async def _run(self, job: dict):
+		lock = self._chat_locks.setdefault(job["chatId"], asyncio.Lock())
+		async with lock:
+			job["status"] = "running"
+			job["startedAt"] = time.time()
+			try:
+				job["result"] = await self.handler(job["chatId"])
+				job["status"] = "completed"
+			except Exception as e:
+				print(e)
+				job["error"] = str(e)
+				job["status"] = "failed"
+			finally:
+				job["finishedAt"] = time.time()
+				if self._active.get(job["chatId"]) == job["id"]:
+					del self._active[job["chatId"]]
+		# Forget the lock once no job of the chat is queued or waiting for it
+		if job["chatId"] not in self._active and not lock.locked():
+			self._chat_locks.pop(job["chatId"], None)
+
+	def _prune(self):
+		# Forget finished jobs once their result has expired
+		expiry = time.time() - self.ttl
+		for jobId in [jobId for jobId, job in self.jobs.items() if job["finishedAt"] and job["finishedAt"] < expiry]:
+			del self.jobs[jobId]
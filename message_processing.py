@@ -1,68 +1,172 @@
-import os
-import json
+import asyncio
+import time
 from telethon.tl.types import Message
+from telethon.utils import get_peer_id
 from models import ChatMessage
+from prefilter import filter_expense_messages
 from agent import format_chats_to_structured_json
-from config import DATA_DIR
-from datetime import datetime
-from database import session_scope, Group, get_user_from_tgId, get_settlements
-from sqlalchemy import cast, String
+from archive import append_messages
+from summaries import get_cached_group_summary
+from ratelimit import telegram_bucket
+from metrics import stage_timer, MESSAGES_FETCHED, PREFILTER_TOKENS_SAVED
+from config import SINGLE_FLIGHT_TTL, PREFILTER_ENABLED, PREFILTER_CONTEXT, ALLOWED_CHATS
+from database import (run_db, get_processing_cursor, update_processing_cursor,
+					  try_acquire_chat_lock, release_chat_lock, store_chat_messages, get_stored_messages,
+					  store_chat_participants, get_chat_participant_ids)
 
-
-# In-memory chat storage
-chats = {}
+# Analyses in flight and recently finished ones, keyed by canonical peer id
+_inflight = {}
+_recent = {}
 
 async def process_messages(client, chat_id):
+	# The same chat can be named by username or by id; every key uses the marked peer id
 	chat = await client.get_entity(chat_id)
+	peer_id = get_peer_id(chat)
+	key = str(peer_id)
+	recent = _recent.get(key)
+	if recent:
+		if recent[0] > time.monotonic():
+			return recent[1]
+		del _recent[key]
+
+	# Concurrent callers for the same chat share a single analysis
+	task = _inflight.get(key)
+	if task is None:
+		task = asyncio.ensure_future(_process_messages_locked(client, chat, peer_id))
+		_inflight[key] = task
+		task.add_done_callback(lambda done: _finish_flight(key, done))
+	return await asyncio.shield(task)
+
+def _finish_flight(key, task):
+	_inflight.pop(key, None)
+	now = time.monotonic()
+	# Drop expired results so payloads of chats not asked for again are not kept forever
+	for expiredKey in [recentKey for recentKey, (expiresAt, _) in _recent.items() if expiresAt <= now]:
+		del _recent[expiredKey]
+	if not task.cancelled() and task.exception() is None:
+		_recent[key] = (now + SINGLE_FLIGHT_TTL, task.result())
+
+# Seconds between attempts to take a chat lock held by another worker
+CHAT_LOCK_POLL_SECONDS = 0.5
+
+async def _acquire_chat_lock(key):
+	# Poll rather than block, so waiting holds neither a thread nor a running statement
+	while True:
+		connection = await asyncio.to_thread(try_acquire_chat_lock, key)
+		if connection is not None:
+			return connection
+		await asyncio.sleep(CHAT_LOCK_POLL_SECONDS)
+
+async def _process_messages_locked(client, chat, peer_id):
+	# The advisory lock extends the guarantee to other workers sharing the database
+	connection = await _acquire_chat_lock(str(peer_id))
+	try:
+		return await _process_messages(client, chat, peer_id)
+	finally:
+		await asyncio.to_thread(release_chat_lock, connection, str(peer_id))
+
+# Items Telegram returns per history and participants request
+MESSAGES_PAGE_SIZE = 100
+PARTICIPANTS_PAGE_SIZE = 200
+
+# Chats whose local store has been caught up with Telegram since startup. Only chats the
+# live handlers keep current belong here, others are synced from the cursor on every run
+_synced_chats = set()
+
+def is_chat_synced(peer_id):
+	return peer_id in _synced_chats
+
+def message_to_row(peer_id, message, sender_is_bot):
+	return {
+		"chatId": peer_id,
+		"messageId": message.id,
+		"senderId": message.sender_id,
+		"senderIsBot": sender_is_bot,
+		"text": message.text,
+		"date": message.date.replace(tzinfo=None) if message.date else None
+	}
+
+async def _sync_chat(client, chat, peer_id, min_id):
+	# One-off catch-up for what the live handlers missed while the process was down
+	# Every page is a request, so each one takes a token before it is fetched
+	participants = []
+	await telegram_bucket.acquire()
+	with stage_timer("telegram_participants"):
+		async for participant in client.iter_participants(chat):
+			participants.append((participant.id, bool(participant.bot)))
+			if len(participants) % PARTICIPANTS_PAGE_SIZE == 0:
+				await telegram_bucket.acquire()
+	await run_db(store_chat_participants, peer_id, participants)
+
+	# Start from the processing cursor, not the newest stored message: live handlers may
+	# have stored newer messages while older ones are still missing. Overlaps are upserts
+	while True:
+		await telegram_bucket.acquire()
+		with stage_timer("telegram_messages"):
+			page = [message async for message in client.iter_messages(chat, limit=MESSAGES_PAGE_SIZE, min_id=min_id, reverse=True)]
+		rows = [
+			message_to_row(peer_id, message, bool(getattr(message.sender, 'bot', False)))
+			for message in page if isinstance(message, Message) and message.text
+		]
+		MESSAGES_FETCHED.inc(len(rows), source="telegram")
+		await run_db(store_chat_messages, rows)
+		if len(page) < MESSAGES_PAGE_SIZE:
+			break
+		min_id = page[-1].id
+	if peer_id in ALLOWED_CHATS:
+		_synced_chats.add(peer_id)
+
+async def _process_messages(client, chat, peer_id):
+	chat_id = str(peer_id)
 	messages = []
-	members = []
-	
-	last_processed = chats.get(chat_id, {}).get("last_processed")
-	
-	async for participant in client.iter_participants(chat):
-		if not participant.bot:
-			members.append(participant.id)
-	
-	async for message in client.iter_messages(chat, offset_date=last_processed, reverse=True):
-		if (isinstance(message, Message) and 
-			message.text and 
-			not message.text.startswith('/') and 
-			not message.sender.bot):
+
+	# Only messages after the stored cursor are read and sent to the model
+	last_message_id = await run_db(get_processing_cursor, chat_id)
+	newest_message_id = last_message_id
+
+	if peer_id not in _synced_chats:
+		await _sync_chat(client, chat, peer_id, last_message_id)
+
+	with stage_timer("store_read"):
+		members = await run_db(get_chat_participant_ids, peer_id)
+		stored_messages = await run_db(get_stored_messages, peer_id, last_message_id)
+	MESSAGES_FETCHED.inc(len(stored_messages), source="store")
+
+	for message in stored_messages:
+		newest_message_id = max(newest_message_id, message.messageId)
+		if (message.text and
+			not message.text.startswith('/') and
+			not message.senderIsBot):
 			messages.append(ChatMessage(
 				role="user",
 				content={
-					"message_id": message.id,
+					"message_id": message.messageId,
 					"text": message.text,
 					"date": message.date.isoformat(),
-					"from_user": str(message.sender_id) if message.sender_id else None
+					"from_user": str(message.senderId) if message.senderId else None
 				}
 			))
 
 	if messages:
-		file_path = os.path.join(DATA_DIR, f"{chat_id}_messages.json")
-		with open(file_path, "w") as f:
-			serializable_messages = [msg.dict() for msg in messages]
-			json.dump(serializable_messages, f, indent=4)
+		with stage_timer("archive"):
+			archived = await asyncio.to_thread(append_messages, chat_id, [msg.content for msg in messages])
+		print(f"Archived {archived} messages for chat {chat_id}")
+
+	if messages and PREFILTER_ENABLED:
+		messages, stats = filter_expense_messages(messages, PREFILTER_CONTEXT)
+		PREFILTER_TOKENS_SAVED.inc(stats['tokensSaved'])
+		print(f"Pre-filter kept {stats['keptMessages']} of {stats['messages']} messages for chat {chat_id}, saving {stats['tokensSaved']} tokens")
+
+	if messages:
+		processed_group = await format_chats_to_structured_json(messages, members, peer_id)
 
-		processed_group = format_chats_to_structured_json(messages, members, chat_id)
-		
 		print(f"Saved {len(messages)} messages for chat {chat_id}")
+		if processed_group is None:
+			# Leave the cursor in place so the window is retried on the next run
+			return None
 	else:
-		with session_scope() as session:
-			dbGroup = session.query(Group).filter(cast(Group.tgId, String) == str(chat_id)).first()			
-			if dbGroup:
-				processed_group = {
-					"group": {
-						"tgId": dbGroup.tgId,
-						"name": dbGroup.name,
-						"description": dbGroup.description,
-						"currency": dbGroup.currency,
-						"members": [get_user_from_tgId(member.user.tgId) for member in dbGroup.members]
-					},
-					"settlements": get_settlements(str(chat_id))
-				}
-			else:
-				processed_group = None
-		
-	chats[chat_id] = {"last_processed": datetime.now()}
-	return processed_group
\ No newline at end of file
+		_, processed_group = await get_cached_group_summary(chat_id)
+
+	if newest_message_id > last_message_id:
+		await run_db(update_processing_cursor, chat_id, newest_message_id)
+	return processed_group
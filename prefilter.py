@@ -0,0 +1,67 @@
+from typing import Callable, Dict, List, Tuple
+from chunking import message_tokens
+from models import ChatMessage
+import re
+
+# A rule receives the message text and returns True when it may describe an expense
+Rule = Callable[[str], bool]
+
+CURRENCY_AMOUNT = re.compile(
+    r"[€$£¥₹]\s?\d|\d(?:[\d.,]*\d)?\s?(?:[€$£¥₹]|\b(?:eur|euro|euros|usd|dollars?|gbp|pounds?|chf|k)\b)",
+    re.IGNORECASE
+)
+# Numbers that are not clearly a time (12:30) or a date (12/05, 2024-05-12)
+AMOUNT_TOKEN = re.compile(r"(?<![\d:/-])\d+(?:[.,]\d{1,2})?(?![\d:/-])")
+EXPENSE_KEYWORDS = re.compile(
+    r"\b(?:paid|pay|paying|spent|spend|cost|costs|bought|buy|owe|owes|split|bill|receipt|refund|"
+    r"rent|ticket|tickets|groceries|dinner|lunch|taxi|hotel|fuel|"
+    r"pagato|pagata|pago|pagare|speso|spesa|costo|costa|conto|scontrino|debito|rimborso)\b",
+    re.IGNORECASE
+)
+
+def has_currency_amount(text: str) -> bool:
+    return bool(CURRENCY_AMOUNT.search(text))
+
+def has_amount_token(text: str) -> bool:
+    return bool(AMOUNT_TOKEN.search(text))
+
+def has_expense_keyword(text: str) -> bool:
+    return bool(EXPENSE_KEYWORDS.search(text))
+
+EXPENSE_RULES: List[Rule] = [has_currency_amount, has_amount_token, has_expense_keyword]
+
+def register_rule(rule: Rule):
+    """
+    Add a rule to the pre-filter. A message is kept when any rule matches it.
+
+    :param rule: Callable receiving the message text
+    """
+    EXPENSE_RULES.append(rule)
+
+def is_expense_candidate(text: str) -> bool:
+    return any(rule(text) for rule in EXPENSE_RULES)
+
+def filter_expense_messages(messages: List[ChatMessage], context: int = 1) -> Tuple[List[ChatMessage], Dict[str, int]]:
+    """
+    Keep the messages that may describe an expense, plus the messages around them.
+
+    :param messages: Messages in chronological order
+    :param context: Number of neighbouring messages kept on each side of a match
+    :return: Kept messages in order, and statistics about the tokens saved
+    """
+    matches = [index for index, message in enumerate(messages) if is_expense_candidate(message.content.get("text") or "")]
+    keep = set()
+    for index in matches:
+        keep.update(range(max(0, index - context), min(len(messages), index + context + 1)))
+    kept = [message for index, message in enumerate(messages) if index in keep]
+
+    tokensBefore = sum(message_tokens(message) for message in messages)
+    tokensAfter = sum(message_tokens(message) for message in kept)
+    stats = {
+        "messages": len(messages),
+        "keptMessages": len(kept),
+        "tokensBefore": tokensBefore,
+        "tokensAfter": tokensAfter,
+        "tokensSaved": tokensBefore - tokensAfter
+    }
+    return kept, stats
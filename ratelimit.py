@@ -0,0 +1,39 @@
+import asyncio
+import time
+from config import TELEGRAM_REQUESTS_PER_SECOND, TELEGRAM_BURST, OPENAI_RPM, OPENAI_TPM
+
+
+class TokenBucket:
+	"""
+	Async token bucket: up to `capacity` tokens, refilled at `rate` tokens per second.
+
+	Requests larger than the capacity are capped to it, so they wait for a full
+	bucket instead of forever.
+	"""
+
+	def __init__(self, rate: float, capacity: float):
+		self.rate = rate
+		self.capacity = capacity
+		self._tokens = capacity
+		self._updatedAt = time.monotonic()
+		self._lock = asyncio.Lock()
+
+	def _refill(self):
+		now = time.monotonic()
+		self._tokens = min(self.capacity, self._tokens + (now - self._updatedAt) * self.rate)
+		self._updatedAt = now
+
+	async def acquire(self, tokens: float = 1):
+		tokens = min(tokens, self.capacity)
+		# Waiters are served in order, so large requests are not starved by small ones
+		async with self._lock:
+			self._refill()
+			while self._tokens < tokens:
+				await asyncio.sleep((tokens - self._tokens) / self.rate)
+				self._refill()
+			self._tokens -= tokens
+
+
+telegram_bucket = TokenBucket(TELEGRAM_REQUESTS_PER_SECOND, TELEGRAM_BURST)
+openai_requests_bucket = TokenBucket(OPENAI_RPM / 60, OPENAI_RPM)
+openai_tokens_bucket = TokenBucket(OPENAI_TPM / 60, OPENAI_TPM)
@@ -1,12 +1,68 @@
-from fastapi import APIRouter, HTTPException, Request
+import json
+import time
+from datetime import date, datetime, timedelta
+from typing import Callable
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from fastapi.routing import APIRoute
+from telethon.errors import FloodWaitError
 from telethon.tl.functions.messages import GetCommonChatsRequest
 from telethon.tl.types import Chat
-from config import MY_USER_ID, TEST_USER_ID
+from cache import AsyncTTLCache, RateLimited
+from config import MY_USER_ID, TEST_USER_ID, GROUPS_CACHE_TTL, GROUPS_CACHE_STALE_TTL, GROUPS_CACHE_NEGATIVE_TTL
 from message_processing import process_messages
-from database import complete_settlements
+from database import (complete_settlements, complete_group_settlements, run_db, get_group_from_tgId,
+					  get_group_transactions, iter_group_transactions, get_spend_aggregates, SPEND_GRANULARITIES)
+from summaries import group_summary_cache, get_cached_group_summary, etag_matches
+from utils import FastJSONResponse, encode_cursor, decode_cursor
+from jobs import JobManager
+from ratelimit import telegram_bucket
+import metrics
+
+class TimedRoute(APIRoute):
+	# Records the latency of every request in a histogram labelled by route template
+	def get_route_handler(self) -> Callable:
+		handler = super().get_route_handler()
+
+		async def timed_handler(request: Request) -> Response:
+			start = time.perf_counter()
+			status = 500
+			try:
+				response = await handler(request)
+				status = response.status_code
+				return response
+			except HTTPException as e:
+				status = e.status_code
+				raise
+			finally:
+				metrics.HTTP_REQUEST_SECONDS.observe(
+					time.perf_counter() - start, method=request.method, route=self.path, status=status
+				)
+
+		return timed_handler
 
 def create_router(client):
-	router = APIRouter()
+	router = APIRouter(route_class=TimedRoute)
+
+	jobs = JobManager(lambda chatId: process_messages(client, chatId))
+	jobs.start()
+
+	async def load_common_chats(userId):
+		await telegram_bucket.acquire()
+		common_chats = await client(GetCommonChatsRequest(user_id=userId, max_id=0, limit=100))
+		return [
+			{
+				"id": chat.id,
+				"title": chat.title,
+				"type": "group" if isinstance(chat, Chat) else "channel"
+			}
+			for chat in common_chats.chats
+		]
+
+	common_chats_cache = AsyncTTLCache(
+		load_common_chats, GROUPS_CACHE_TTL, GROUPS_CACHE_STALE_TTL, GROUPS_CACHE_NEGATIVE_TTL,
+		rateLimitErrors=(FloodWaitError,)
+	)
 
 	@router.get("/groups")
 	async def get_chats(userId: int = None):
@@ -15,15 +71,7 @@ def create_router(client):
 				if userId == MY_USER_ID:
 					userId = TEST_USER_ID
 
-				common_chats = await client(GetCommonChatsRequest(user_id=userId, max_id=0, limit=100))
-				chats = [
-					{
-						"id": chat.id,
-						"title": chat.title,
-						"type": "group" if isinstance(chat, Chat) else "channel"
-					}
-					for chat in common_chats.chats
-				]
+				chats = await common_chats_cache.get(userId)
 
 
 				# for test purposes, return the chats filtered by the allowed groups id
@@ -33,6 +81,8 @@ def create_router(client):
 			else:
 				return {"error": "You must first add the bot to the chat you want to analyze"}
 			
+		except RateLimited as e:
+			raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(int(e.retryAfter))})
 		except Exception as e:
 			print(e)
 			raise HTTPException(status_code=500, detail=str(e))
@@ -45,23 +95,142 @@ def create_router(client):
 			
 			if not chatId:
 				raise HTTPException(status_code=400, detail="You must provide a chatId")
+
+			# Background mode answers right away with a job to poll
+			if data.get('background'):
+				job = jobs.submit(chatId)
+				return JSONResponse(status_code=202, content={"jobId": job["id"], "status": job["status"]})
 			
 			processed_group = await process_messages(client, chatId)
 			return processed_group
+		except HTTPException:
+			raise
+		except Exception as e:
+			print(e)
+			raise HTTPException(status_code=500, detail=str(e))
+
+	@router.get("/groups/{groupTgId}/summary")
+	async def get_group_summary_endpoint(groupTgId: str, request: Request):
+		try:
+			etag, summary = await get_cached_group_summary(groupTgId)
 		except Exception as e:
 			print(e)
 			raise HTTPException(status_code=500, detail=str(e))
+		if summary is None:
+			raise HTTPException(status_code=404, detail="Group not found")
+
+		# Clients revalidate every poll, unchanged summaries cost a version lookup
+		headers = {"ETag": etag, "Cache-Control": "no-cache"}
+		ifNoneMatch = request.headers.get("if-none-match")
+		if ifNoneMatch and etag_matches(ifNoneMatch, etag):
+			return Response(status_code=304, headers=headers)
+		return FastJSONResponse(summary, headers=headers)
+
+	@router.get("/groups/{groupTgId}/transactions")
+	async def get_group_transactions_endpoint(groupTgId: str, memberTgId: str = None, dateFrom: date = None, dateTo: date = None,
+											  cursor: str = None, limit: int = Query(100, ge=1, le=500), format: str = "json"):
+		# dateTo is inclusive, the queries take an exclusive upper bound
+		filters = {
+			"memberTgId": memberTgId,
+			"dateFrom": datetime.combine(dateFrom, datetime.min.time()) if dateFrom else None,
+			"dateTo": datetime.combine(dateTo + timedelta(days=1), datetime.min.time()) if dateTo else None
+		}
+		try:
+			after = None
+			if cursor:
+				afterDate, afterId = decode_cursor(cursor)
+				after = (datetime.fromisoformat(afterDate) if afterDate else None, int(afterId))
+		except (ValueError, TypeError):
+			raise HTTPException(status_code=400, detail="Invalid cursor")
+
+		try:
+			group = await run_db(get_group_from_tgId, groupTgId)
+			if group is None:
+				raise HTTPException(status_code=404, detail="Group not found")
+
+			# Export mode streams every matching row, read through a server-side cursor
+			if format == "ndjson":
+				lines = (json.dumps(row) + "\n" for row in iter_group_transactions(group["id"], **filters))
+				return StreamingResponse(lines, media_type="application/x-ndjson")
+
+			transactions, nextKey = await run_db(get_group_transactions, group["id"], after=after, limit=limit, **filters)
+			return {"transactions": transactions, "nextCursor": encode_cursor(nextKey) if nextKey else None}
+		except HTTPException:
+			raise
+		except Exception as e:
+			print(e)
+			raise HTTPException(status_code=500, detail=str(e))
+
+	@router.get("/groups/{groupTgId}/aggregates")
+	async def get_spend_aggregates_endpoint(groupTgId: str, granularity: str = "week", memberTgId: str = None,
+											dateFrom: date = None, dateTo: date = None):
+		if granularity not in SPEND_GRANULARITIES:
+			raise HTTPException(status_code=400, detail=f"granularity must be one of {', '.join(SPEND_GRANULARITIES)}")
+		try:
+			group = await run_db(get_group_from_tgId, groupTgId)
+			if group is None:
+				raise HTTPException(status_code=404, detail="Group not found")
+
+			# Buckets overlapping the inclusive date range
+			aggregates = await run_db(
+				get_spend_aggregates, group["id"], granularity, memberTgId,
+				datetime.combine(dateFrom, datetime.min.time()) if dateFrom else None,
+				datetime.combine(dateTo + timedelta(days=1), datetime.min.time()) if dateTo else None
+			)
+			return {"granularity": granularity, "aggregates": aggregates}
+		except HTTPException:
+			raise
+		except Exception as e:
+			print(e)
+			raise HTTPException(status_code=500, detail=str(e))
+
+	@router.get("/jobs/{jobId}")
+	async def get_job(jobId: str):
+		job = jobs.get(jobId)
+		if not job:
+			raise HTTPException(status_code=404, detail="Job not found")
+		return job
+
+	@router.get("/metrics")
+	async def get_metrics():
+		metrics.JOB_QUEUE_DEPTH.set(jobs.queue.qsize())
+		return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 	@router.post("/complete-settlements")
 	async def complete_settlements_endpoint(request: Request):
 		try:
 			data = await request.json()
 			settlement_ids = data.get('settlementIds')
-			updated_count = complete_settlements(settlement_ids)
+			updated_count = await run_db(complete_settlements, settlement_ids)
+			# The settlements may belong to any group
+			group_summary_cache.clear()
 			return {"message": f"Successfully completed {updated_count} settlements"}
 		except Exception as e:
 			print(e)
 			raise HTTPException(status_code=500, detail=str(e))
 
 
+	@router.post("/groups/{groupTgId}/settlements/complete")
+	async def complete_group_settlements_endpoint(groupTgId: str, request: Request):
+		try:
+			data = await request.json()
+			settlement_ids = data.get('settlementIds')
+			if not isinstance(settlement_ids, list) or not settlement_ids or not all(isinstance(i, int) for i in settlement_ids):
+				raise HTTPException(status_code=400, detail="settlementIds must be a non-empty list of ids")
+
+			result = await run_db(complete_group_settlements, groupTgId, settlement_ids)
+			if result is None:
+				raise HTTPException(status_code=404, detail="Group not found")
+			completed, rejected = result
+			group_summary_cache.invalidate(groupTgId)
+
+			# Nothing applied is a conflict, the client holds stale or foreign ids
+			content = {"completed": completed, "count": len(completed), "rejected": rejected}
+			return JSONResponse(status_code=409 if not completed else 200, content=content)
+		except HTTPException:
+			raise
+		except Exception as e:
+			print(e)
+			raise HTTPException(status_code=500, detail=str(e))
+
 	return router
\ No newline at end of file
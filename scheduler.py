@@ -0,0 +1,50 @@
+import asyncio
+from config import ALLOWED_CHATS, SCHEDULER_INTERVAL, SCHEDULER_CONCURRENCY
+from database import DB_POOL_SIZE, run_db, get_chat_backlogs
+from message_processing import process_messages, is_chat_synced
+
+
+class ChatScheduler:
+	"""
+	Periodically analyse the allowed chats, the largest backlog first.
+
+	Chats run in parallel, bounded by `concurrency` and by the database pool size.
+	Telegram and OpenAI calls are further limited by the shared token buckets in
+	ratelimit. Chats with no stored messages past their cursor are skipped, unless
+	their store has not been caught up with Telegram since startup.
+	"""
+
+	def __init__(self, client, interval: int = SCHEDULER_INTERVAL, concurrency: int = SCHEDULER_CONCURRENCY):
+		self.client = client
+		self.interval = interval
+		self.concurrency = min(concurrency, DB_POOL_SIZE)
+
+	async def run_forever(self):
+		while True:
+			try:
+				await self.run_once()
+			except Exception as e:
+				print(e)
+			await asyncio.sleep(self.interval)
+
+	async def run_once(self):
+		chatIds = set(ALLOWED_CHATS)
+		backlogs = await run_db(get_chat_backlogs, list(chatIds))
+
+		# Unsynced chats have an unknown backlog, they go after the known ones
+		pending = [chatId for chatId in chatIds if backlogs.get(chatId) or not is_chat_synced(chatId)]
+		pending.sort(key=lambda chatId: (is_chat_synced(chatId), backlogs.get(chatId, 0)), reverse=True)
+		if not pending:
+			return
+
+		print(f"Scheduling {len(pending)} of {len(chatIds)} chats")
+		semaphore = asyncio.Semaphore(self.concurrency)
+
+		async def process(chatId):
+			async with semaphore:
+				try:
+					await process_messages(self.client, chatId)
+				except Exception as e:
+					print(f"Scheduled processing of chat {chatId} failed: {e}")
+
+		await asyncio.gather(*[process(chatId) for chatId in pending])
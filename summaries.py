@@ -0,0 +1,39 @@
+"""
+Cached group summaries, versioned by an ETag and revalidated against the group's version.
+"""
+import hashlib
+import json
+from cache import AsyncTTLCache
+from config import GROUP_SUMMARY_CACHE_TTL
+from database import run_db, get_group_summary, get_group_version
+
+def summary_etag(summary: dict) -> str:
+    payload = json.dumps(summary, sort_keys=True, default=str)
+    return '"' + hashlib.sha256(payload.encode()).hexdigest()[:32] + '"'
+
+async def _load_group_summary(groupTgId: str):
+    # Version first: the summary read after it is at least that recent
+    version = await run_db(get_group_version, groupTgId)
+    summary = await run_db(get_group_summary, groupTgId)
+    return version, (summary_etag(summary) if summary is not None else None), summary
+
+# Values are (version, etag, summary), with a None summary for unknown groups
+group_summary_cache = AsyncTTLCache(_load_group_summary, GROUP_SUMMARY_CACHE_TTL, 0, 0)
+
+async def get_cached_group_summary(groupTgId: str):
+    """
+    Get the (etag, summary) of a group, None summary if it does not exist.
+
+    Writes from any worker bump Groups.version, so a cached entry is checked with a
+    single indexed lookup of the version and reloaded when it changed.
+    """
+    version = await run_db(get_group_version, groupTgId)
+    cachedVersion, etag, summary = await group_summary_cache.get(groupTgId)
+    if cachedVersion != version:
+        group_summary_cache.invalidate(groupTgId)
+        cachedVersion, etag, summary = await group_summary_cache.get(groupTgId)
+    return etag, summary
+
+def etag_matches(ifNoneMatch: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in ifNoneMatch.split(",")]
+    return "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
@@ -1,75 +1,141 @@
 from typing import Dict, List, Any
+from datetime import datetime
 from decimal import Decimal, ROUND_HALF_UP
-from sqlalchemy.ext.declarative import DeclarativeMeta
+from operator import attrgetter
+from sqlalchemy import inspect
+from starlette.responses import JSONResponse
+import base64
+import heapq
 import json
 
-class AlchemyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj.__class__, DeclarativeMeta):
-            # Convert SQLAlchemy model to dictionary
-            fields = {}
-            for field in [x for x in dir(obj) if not x.startswith('_') and x != 'metadata']:
-                data = obj.__getattribute__(field)
-                try:
-                    json.dumps(data)
-                    fields[field] = data
-                except TypeError:
-                    fields[field] = None
-            return fields
-        return json.JSONEncoder.default(self, obj)
-
-def calculate_settlement(expenseData: Dict[str, Any]) -> List[Dict[str, Any]]:
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class ColumnSerializer:
     """
-    Calculate the settlement transactions based on the expense data.
-    
-    :param expenseData: Dictionary containing the expense tracking data
-    :return: List of settlement transactions
+    Serialize model instances or result rows to dictionaries of their column values.
+
+    The column list is resolved once per model, so only loaded column attributes are
+    read and relationships are never touched (or lazily loaded).
+    """
+    def __init__(self, model, exclude=()):
+        self.columns = [attr.key for attr in inspect(model).column_attrs if attr.key not in exclude]
+        self._getter = attrgetter(*self.columns)
+
+    def __call__(self, obj) -> Dict[str, Any]:
+        values = self._getter(obj)
+        if len(self.columns) == 1:
+            values = (values,)
+        return {column: _json_value(value) for column, value in zip(self.columns, values)}
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+class FastJSONResponse(JSONResponse):
+    # Render with orjson when it is installed
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+def encode_cursor(values: list) -> str:
+    # Opaque pagination cursor holding the sort key of the last row served
+    payload = json.dumps([_json_value(value) for value in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+CENT = Decimal('0.01')
+
+def to_cents(value) -> Decimal:
+    return Decimal(str(value)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+def net_balances(paid: Dict[str, Any]) -> Dict[str, Decimal]:
+    """
+    Compute each member's net position from the amounts they paid into the ledger.
+
+    The expenses are split equally; the cents that do not divide evenly are
+    assigned one by one in user id order, so the positions always sum to zero.
+
+    :param paid: Mapping of user id to the total amount paid by that member
+    :return: Mapping of user id to net position (positive means the member is owed)
     """
-    # Convert relevant values to Decimal for precise calculations
-    totalExpenses = Decimal(str(expenseData['totalExpenses']))
-    averagePerPerson = Decimal(str(expenseData['averagePerPerson']))
-    
-    # Calculate how much each person owes or is owed
+    if not paid:
+        return {}
+    paidCents = {userId: to_cents(amount) for userId, amount in paid.items()}
+    totalCents = int(sum(paidCents.values(), Decimal('0')) / CENT)
+    share, remainder = divmod(totalCents, len(paidCents))
     balances = {}
-    for member in expenseData['group']['members']:
-        userId = member['tgId']
-        paid = Decimal(str(member['paid']))
-        balance = paid - averagePerPerson
-        balances[userId] = balance.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
-    
-    # Separate into those who owe money and those who are owed
-    debtors = [(userId, -amount) for userId, amount in balances.items() if amount < 0]
-    creditors = [(userId, amount) for userId, amount in balances.items() if amount > 0]
-    
-    # Sort both lists by amount (largest first)
-    debtors.sort(key=lambda x: x[1], reverse=True)
-    creditors.sort(key=lambda x: x[1], reverse=True)
-    
-    # Calculate settlements
+    for index, userId in enumerate(sorted(paidCents)):
+        owed = (share + (1 if index < remainder else 0)) * CENT
+        balances[userId] = paidCents[userId] - owed
+    return balances
+
+def settle_balances(balances: Dict[str, Decimal], minimizeTransfers: bool = False) -> List[Dict[str, Any]]:
+    """
+    Compute the transfers that bring every net position to zero in O(n log n).
+
+    The largest debtor always pays the largest creditor, using two heaps. With
+    minimizeTransfers, debts that exactly match a credit are paired first, which
+    removes the transfers the greedy pass would otherwise split in two (finding the
+    true minimum is NP-hard, this is the usual practical approximation).
+
+    :param balances: Mapping of user id to net position, summing to zero
+    :param minimizeTransfers: Pair exactly matching debts and credits first
+    :return: List of settlement transactions
+    """
     settlements = []
+    debtors = [(-to_cents(-amount), userId) for userId, amount in balances.items() if amount < 0]
+    creditors = [(-to_cents(amount), userId) for userId, amount in balances.items() if amount > 0]
+
+    if minimizeTransfers:
+        creditorsByAmount = {}
+        for amount, userId in sorted(creditors):
+            creditorsByAmount.setdefault(amount, []).append(userId)
+        remainingDebtors = []
+        for amount, userId in sorted(debtors):
+            matches = creditorsByAmount.get(amount)
+            if matches:
+                settlements.append({"fromUserId": userId, "toUserId": matches.pop(0), "amount": float(-amount)})
+            else:
+                remainingDebtors.append((amount, userId))
+        debtors = remainingDebtors
+        creditors = [(amount, userId) for amount, userIds in creditorsByAmount.items() for userId in userIds]
+
+    # Amounts are stored negated so the heaps pop the largest balance first
+    heapq.heapify(debtors)
+    heapq.heapify(creditors)
     while debtors and creditors:
-        debtor, debt = debtors.pop(0)
-        creditor, credit = creditors.pop(0)
-        
-        if debt > credit:
-            settlements.append({
-                "fromUserId": debtor,
-                "toUserId": creditor,
-                "amount": float(credit)
-            })
-            debtors.insert(0, (debtor, debt - credit))
-        elif credit > debt:
-            settlements.append({
-                "fromUserId": debtor,
-                "toUserId": creditor,
-                "amount": float(debt)
-            })
-            creditors.insert(0, (creditor, credit - debt))
-        else:
-            settlements.append({
-                "fromUserId": debtor,
-                "toUserId": creditor,
-                "amount": float(debt)
-            })
-    
-    return settlements
\ No newline at end of file
+        debt, debtor = heapq.heappop(debtors)
+        credit, creditor = heapq.heappop(creditors)
+        amount = min(-debt, -credit)
+        settlements.append({"fromUserId": debtor, "toUserId": creditor, "amount": float(amount)})
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, debtor))
+        elif -credit > amount:
+            heapq.heappush(creditors, (credit + amount, creditor))
+
+    return settlements
+
+def calculate_ledger_settlement(paid: Dict[str, Any], minimizeTransfers: bool = False) -> List[Dict[str, Any]]:
+    """
+    Calculate the settlement transactions from the amounts recorded in the ledger.
+
+    :param paid: Mapping of user id to the total amount paid by that member
+    :param minimizeTransfers: Pair exactly matching debts and credits first
+    :return: List of settlement transactions
+    """
+    return settle_balances(net_balances(paid), minimizeTransfers)